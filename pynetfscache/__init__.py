@@ -2,8 +2,31 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
-__all__ = ["LocalFilesystemCache", "SFTPFilesystemCache"]
+import importlib
+import sys
 
+__all__ = ["LocalFilesystemCache", "SFTPFilesystemCache", "RetrieveError",
+           "MetricsHook", "TransferScheduler"]
 
+
+from ._base import RetrieveError
+from ._metrics import MetricsHook
+from ._scheduler import TransferScheduler
 from .local import LocalFilesystemCache
-from .sftp import SFTPFilesystemCache
+
+# backends which are only imported when they are accessed
+_LAZY = {"SFTPFilesystemCache": ".sftp"}
+
+
+def __getattr__(name):
+    # called for missing module attributes from Python 3.7 on
+    if name not in _LAZY:
+        raise AttributeError("module '{}' has no attribute '{}'".format(
+            __name__, name))
+    value = getattr(importlib.import_module(_LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+if sys.version_info < (3, 7):
+    from .sftp import SFTPFilesystemCache
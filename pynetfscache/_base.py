@@ -2,17 +2,295 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+import collections
+import contextlib
 import datetime
+import errno
+import fnmatch
 import glob
+import hashlib
+import io
+import mmap
+import numbers
 import os
+import re
 import shutil
+import stat
 import tempfile
+import threading
+import time
+import timeit
 import warnings
+import weakref
+
+from ._cas import BLOBS_DIRNAME, BlobStore, Hasher, hash_file, hash_fileobj
+from ._codecs import get_codec
+from ._eviction import EvictionPolicy
+from ._files import makedirs, publish, remove
+from ._index import INDEX_FILENAME, CacheIndex
+from ._lock import FileLock
+from ._memory import MemoryTier
+from ._metadata import MetadataCache, normpath
+from ._metrics import Metrics
+from ._prefetch import Prefetcher, SequencePredictor
+from ._scheduler import PRIORITIES
+from ._sparse import (SPARSE_DIRNAME, SparseFile, SparseState,
+                      iter_sparse_files, remove_unused)
+
+
+try:
+    basestring
+except NameError:  # Python 3
+    basestring = str
+
+
+_MAGIC = re.compile("[*?[]")
+
+LOCKS_DIRNAME = ".pynetfscache.locks"
+
+HOT_PREFIX = ".pynetfscache.hot."
+
+
+# bookkeeping for one cached file: local path, fetch time, the
+# signature (size, mtime, inode) of the source at fetch time, the
+# checksum of the contents, if known, and the codec the local copy is
+# compressed with, if any
+_Entry = collections.namedtuple("_Entry", ["temppath", "time", "size",
+                                           "mtime", "ino", "checksum",
+                                           "codec"])
+
+
+def weakmethod(method):
+    """Return a function calling *method* without keeping its object alive
+
+    Helper objects of a cache must not hold bound methods of the
+    cache: in Python 2, the resulting reference cycle would keep the
+    cache, which has a __del__ method, from ever being collected.
+
+    """
+    ref = weakref.ref(method.__self__)
+    func = method.__func__
+
+    def _call(*args, **kwargs):
+        return func(ref(), *args, **kwargs)
+    return _call
+
+
+class _Flight(object):
+    """A retrieval in progress, which other threads can wait for
+
+    Its transfers run with *priority*, which is raised by
+    :meth:`boost` for more urgent waiters.
+
+    """
+
+    def __init__(self, priority="foreground"):
+        self.priority = priority
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def boost(self, priority):
+        """Raise the priority of the transfers to *priority* if lower"""
+        if PRIORITIES.index(priority) < PRIORITIES.index(self.priority):
+            self.priority = priority
+
+    def finish(self, result=None, error=None):
+        self._result, self._error = result, error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+def _compression_rules(compression):
+    """Return a list of (pattern, codec, level) from *compression*"""
+    if not compression:
+        return []
+    if isinstance(compression, basestring):
+        compression = [("*", compression)]
+    rules = []
+    for rule in compression:
+        pattern, name = rule[:2]
+        codec = None if name is None else get_codec(name)
+        if len(rule) > 2:
+            level = rule[2]
+        else:
+            level = None if codec is None else codec.default_level
+        rules.append((pattern, codec, level))
+    return rules
+
+
+def _match_path(path, pattern):
+    """Return whether *path* or one of its directories matches *pattern*"""
+    while True:
+        if fnmatch.fnmatch(path, pattern):
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+def _signature(st):
+    """Return the (size, mtime, inode) signature of a stat result"""
+    return st.st_size, st.st_mtime, getattr(st, "st_ino", None)
+
+
+class RetrieveError(IOError):
+    """Raised when some files of a batch could not be retrieved
+
+    *errors* maps the paths which failed to their exceptions, and
+    *results* holds the local filenames in input order, with None for
+    the failed paths.
+
+    """
+
+    def __init__(self, errors, results):
+        super(RetrieveError, self).__init__(
+            "Could not retrieve {} of {} files: {}".format(
+                len(errors), len(results),
+                ", ".join("{} ({})".format(p, e) for p, e in errors.items())))
+        self.errors = errors
+        self.results = results
 
 
 class FilesystemCache(object):
+    """Base class for all filesystem caches
+
+    *validate* controls how cached entries are checked for freshness
+    before they are served: ``"never"`` serves them without any I/O,
+    ``"always"`` compares the size, mtime and inode of the source on
+    every access, and a number *N* does so at most once every *N*
+    seconds.  An entry is only fetched again if the source changed.
+
+    If *persist* is true, the cached files are recorded in an index
+    inside *temppath*, from which a new cache on the same *temppath*
+    is rehydrated.  It defaults to *keep_tmp*.  The index is trusted:
+    files removed from *temppath* behind the cache's back are not
+    detected.
+
+    The size of the cache can be bounded by *max_bytes*, *max_files*
+    and a minimum of *min_free* bytes of free space on the volume
+    holding *temppath*.  When a limit is exceeded after a retrieval,
+    files are evicted according to *eviction* (``"lru"``, ``"lfu"``
+    or ``"gdsf"``, see :class:`EvictionPolicy`).  Files which are
+    being retrieved or held with :meth:`hold` are never evicted.
+
+    Batches of files are retrieved by up to *workers* threads.
+
+    Directory listings used by :meth:`glob`, :meth:`isdir`,
+    :meth:`isfile` and :meth:`listdir` are cached for *metadata_ttl*
+    seconds and revalidated by the mtime of the directory afterwards
+    (see :class:`MetadataCache`).
+
+    Concurrent retrievals of the same path are coalesced: the first
+    caller fetches the file, the others wait for it and share its
+    result.  If *shared* is true, this also holds across processes
+    using the same *temppath*: fetches are serialized by a file lock
+    per path, and a copy another process made is adopted if it
+    matches the size and mtime of the source.  Files are always
+    published by an atomic rename.  In shared mode, :meth:`hold`
+    takes a lease on its files, which keeps all processes from
+    removing them in :meth:`clean` or :meth:`autoclean`, and cached
+    entries are checked to still exist before they are served.  A
+    shared cache needs an explicit *temppath*, which is never deleted.
+
+    Files can be retrieved in the background with :meth:`prefetch`, by
+    up to *prefetch_workers* threads which pause while a foreground
+    :meth:`retrieve` runs.  If *predict* is a positive number, that
+    many files continuing a numbered sequence of retrieved files (like
+    ``day_001.nc``, ``day_002.nc``) are prefetched.
+
+    If *content_addressed* is true (or the name of a hash function,
+    see :class:`BlobStore`), cached files are hardlinks to blobs named
+    by the hash of their contents, so that identical files are stored
+    once.  A transfer is skipped if the contents of the source are
+    known to be stored already: because the same path was fetched
+    before with the same size and mtime, or because another path has
+    the same source inode (e.g. via a symlinked directory).  Cached
+    files must be treated as read-only in this mode.
+
+    Cached files can be compressed at rest with *compression*: either
+    the name of a codec (``"zstd"``, ``"lz4"``, ``"gzip"``, ``"bz2"``
+    or ``"xz"``) for all files, or a list of ``(pattern, codec)`` or
+    ``(pattern, codec, level)`` tuples, where the first tuple whose
+    glob pattern matches the relative path applies, and a codec of
+    None stores files uncompressed::
+
+        compression=[("*.zip", None), ("*.csv", "zstd", 9), ("*", "lz4")]
+
+    Compressed files are decompressed on access: :meth:`open` streams
+    them, while :meth:`retrieve` decompresses them into a private hot
+    tier inside *temppath*, where they stay until they were not
+    retrieved for *hot_ttl* seconds.  Compression cannot be combined
+    with *content_addressed*, and compressed files are not adopted
+    from other processes in shared mode.
+
+    :meth:`open` reads files which are not cached yet lazily, fetching
+    only the blocks of *range_blocksize* bytes which are read, plus
+    *readahead* following blocks, into a sparse file.  Once all blocks
+    are present, the file becomes a regular cached file.  Sparse files
+    do not count against the size limits of the cache.
+
+    If *checksum* is true (or the name of a hash function, default
+    ``"sha256"``), files are hashed while they are transferred, and
+    the checksum is recorded in the index.  If the source has a
+    sidecar file with the name of the hash function as an extension
+    (like ``data.nc.sha256``, in the format of ``sha256sum``), the
+    copy is checked against it, and discarded with an :class:`IOError`
+    if it doesn't match.  :meth:`verify` checks cached files against
+    their recorded checksums.  In content-addressed mode, the hash
+    function of the blob store is used.
 
-    def __init__(self, sourcepath, temppath=None, keep_tmp=False):
+    Hits, misses, transferred and served bytes, fetch latencies,
+    evictions and the time spent in :meth:`clean` are recorded in
+    :attr:`metrics` (see :class:`Metrics`); :meth:`stats` returns a
+    snapshot.  To export them, add a :class:`MetricsHook` with
+    ``cache.metrics.add_hook(hook)``.
+
+    If *memory_bytes* is given, up to that many bytes of the contents
+    of frequently read files are held in memory, in front of the disk
+    tier in *temppath*, and served by :meth:`read` without touching
+    the disk.  A file is promoted into memory once it was read
+    *promote_hits* times; under pressure, the least frequently read
+    files are demoted (see :class:`MemoryTier`).
+
+    Transfers can be limited in bandwidth and concurrency by a
+    *scheduler* (see :class:`TransferScheduler`), which can be shared
+    with other caches; the host of a local cache is ``"localhost"``.
+    It serves foreground retrievals before :meth:`sync`, and these
+    before prefetches, and lets the threads calling the cache take
+    turns.
+
+    """
+
+    def __init__(self, sourcepath, temppath=None, keep_tmp=False,
+                 validate="always", persist=None, max_bytes=None,
+                 max_files=None, min_free=None, eviction="lru", workers=4,
+                 metadata_ttl=5., shared=False, prefetch_workers=2,
+                 predict=0, content_addressed=False, compression=None,
+                 hot_ttl=60., range_blocksize=4 * 2**20, readahead=1,
+                 checksum=False, memory_bytes=None, promote_hits=2,
+                 scheduler=None):
+        if validate not in ("never", "always") and not (
+                isinstance(validate, numbers.Real) and validate >= 0):
+            raise ValueError("validate must be 'never', 'always' or a "
+                             "non-negative number of seconds, not "
+                             "'{}'".format(validate))
+        if shared and temppath is None:
+            raise ValueError("A shared cache needs an explicit temppath")
+        if compression and content_addressed:
+            raise ValueError("Compression cannot be combined with a "
+                             "content-addressed cache")
         if temppath is not None and not keep_tmp:
             warnings.warn("You specified the temppath '{}', but you also "
                           "told me to remove the temppath when we're done. "
@@ -24,17 +302,109 @@ class FilesystemCache(object):
             self.temppath = temppath
             keep_tmp = True
         self.keep_tmp = keep_tmp
+        self.validate = validate
         self._files = {}
+        self._validated = {}
+        self._index = None
+        self._held = collections.Counter()
+        self._inflight = {}
+        self.shared = shared
+        self._lock = threading.RLock()
+        self._pool = None
+        self.workers = workers
+        self.metrics = Metrics()
+        self.scheduler = scheduler
+        self._context = threading.local()
+        self._memory = None
+        if memory_bytes:
+            self._memory = MemoryTier(memory_bytes, promote_hits)
+        self._metadata = MetadataCache(weakmethod(self._scandir),
+                                       weakmethod(self._stat), metadata_ttl)
+        self._prefetcher = Prefetcher(weakmethod(self._prefetch_single),
+                                      prefetch_workers)
+        self._predictor = SequencePredictor(predict) if predict else None
+        self._blobs = None
+        if content_addressed:
+            self._blobs = BlobStore(
+                os.path.join(self.temppath, BLOBS_DIRNAME),
+                None if content_addressed is True else content_addressed)
+        self._digests = {}
+        self._contents = {}
+        if checksum and content_addressed and checksum is not True and \
+                checksum != self._blobs.hashname:
+            raise ValueError("The checksum of a content-addressed cache "
+                             "must use its hash function '{}'".format(
+                                 self._blobs.hashname))
+        if self._blobs is not None:
+            self._hashname = self._blobs.hashname
+        elif checksum:
+            self._hashname = "sha256" if checksum is True else checksum
+            Hasher(self._hashname)  # fail early for unknown hash functions
+        else:
+            self._hashname = None
+        self.checksum = bool(checksum)
+        self._compression = _compression_rules(compression)
+        self.hot_ttl = hot_ttl
+        self._hotdir = None
+        self._hot = {}
+        self._hot_expired = time.time()
+        self.range_blocksize = range_blocksize
+        self.readahead = readahead
+        self._sparse = {}
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.min_free = min_free
+        if (max_bytes, max_files, min_free) != (None, None, None):
+            self._eviction = EvictionPolicy(eviction)
+        else:
+            self._eviction = None
         self.sourcepath = sourcepath
         self._check_init()
+        if persist is None:
+            persist = keep_tmp
+        if persist:
+            self._load_index()
 
     def __del__(self):
-        if not self.keep_tmp:
+        if getattr(self, "_prefetcher", None) is not None:
+            self._prefetcher.stop()
+        if getattr(self, "_pool", None) is not None:
+            self._pool.close()
+        if getattr(self, "_index", None) is not None:
+            self._index.close()
+        if getattr(self, "_hotdir", None) is not None:
+            shutil.rmtree(self._hotdir, ignore_errors=True)
+        # keep_tmp is unset if __init__ failed before creating temppath
+        if not getattr(self, "keep_tmp", True):
             shutil.rmtree(self.temppath)
 
+    def _load_index(self):
+        makedirs(self.temppath)
+        self._index = CacheIndex(os.path.join(self.temppath, INDEX_FILENAME))
+        for row in self._index.load():
+            path = row["path"]
+            temppath = self._construct_temppath(path)
+            size = row["size"]
+            if row["codec"] is not None:
+                temppath += get_codec(row["codec"]).ext
+                try:
+                    size = os.path.getsize(temppath)
+                except OSError:
+                    pass
+            self._files[path] = _Entry(
+                temppath, datetime.datetime.fromtimestamp(row["fetched"]),
+                row["size"], row["mtime"], row["ino"], row["checksum"],
+                row["codec"])
+            if row["checksum"] is not None:
+                self._remember_digest(path, (row["size"], row["mtime"],
+                                             row["ino"]), row["checksum"])
+            if self._eviction is not None:
+                self._eviction.add(path, size, row["accessed"],
+                                   row["hits"] + 1)
+        self.autoclean()
+
     def __call__(self, path):
-        # TODO: support path as glob
-        return self._files.get(path, self.retrieve(path))[0]
+        return self.retrieve(path)
 
     def __enter__(self):
         return self
@@ -53,14 +423,7 @@ class FilesystemCache(object):
         return os.path.join(self.temppath, os.path.dirname(path))
 
     def _prepare_targetpath(self, path):
-        targetdir = self._construct_temptargetdir(path)
-        try:
-            os.makedirs(targetdir)
-        except OSError as err:
-            if err.errno == 17:
-                pass
-            else:
-                raise
+        makedirs(self._construct_temptargetdir(path))
 
     def retrieve(self, path):
         """Retrieve files from remote storage
@@ -68,22 +431,683 @@ class FilesystemCache(object):
         This method retrieves the file with relative path *path* from
         the remote storage and returns the filename to local storage
 
+        If *path* is a list or another iterable of paths, the files
+        are retrieved concurrently by up to :attr:`workers` threads,
+        and a list of local filenames in the same order is returned.
+        Failures do not stop the other retrievals; they are collected
+        and raised together as a :class:`RetrieveError` in the end.
+
+        If *path* contains glob wildcards (``*``, ``?`` or ``[``), it
+        is expanded with :meth:`glob` and all matches are retrieved
+        as one batch; the list of local filenames is sorted.
+
         """
+        with self._prefetcher.foreground():
+            retval = self._retrieve_any(path)
+        if (self._predictor is not None and
+                isinstance(path, basestring) and not _MAGIC.search(path)):
+            self._prefetcher.put(self._predictor.observe(path))
+        return retval
+
+    def _retrieve_any(self, path):
         if isinstance(path, basestring):
-            self._retrieve(path)
-            retval = self._files[path][0]
-        elif isinstance(path, list):
-            retval = []
-            for p in path:
-                self._retrieve(p)
-                retval.append(self._files[p][0])
-        else:
+            if _MAGIC.search(path):
+                return self._retrieve_any(self._expand(path))
+            return self._retrieve_single(path)
+        try:
+            paths = list(path)
+        except TypeError:
             raise ValueError("You passed an object of class '{}' as "
                              "path".format(path.__class__))
+        if self.workers > 1 and len(paths) > 1:
+            outcomes = self._get_pool().map(
+                self._in_context(self._retrieve_guarded), paths)
+        else:
+            outcomes = [self._retrieve_guarded(p) for p in paths]
+        errors = collections.OrderedDict(
+            (p, err) for p, (_, err) in zip(paths, outcomes)
+            if err is not None)
+        retval = [result for result, _ in outcomes]
+        if errors:
+            raise RetrieveError(errors, retval)
         return retval
 
+    def prefetch(self, path):
+        """Retrieve files in the background
+
+        *path* is a relative path, a glob pattern or an iterable of
+        paths, like for :meth:`retrieve`.  This returns immediately;
+        a later :meth:`retrieve` of a prefetched path waits for the
+        prefetch if it is still running.  Paths which don't exist
+        are skipped.
+
+        """
+        if isinstance(path, basestring):
+            paths = self._expand(path) if _MAGIC.search(path) else [path]
+        else:
+            paths = list(path)
+        self._prefetcher.put(paths)
+
+    def _prefetch_single(self, path):
+        if self._metadata.mode(path) is not None:
+            with self._scheduled("prefetch"):
+                self._retrieve_entry(path)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # imported here, as multiprocessing is slow to import
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.workers)
+            return self._pool
+
+    def _retrieve_guarded(self, path):
+        try:
+            return self._retrieve_single(path), None
+        except Exception as err:
+            return None, err
+
     def _retrieve_single(self, path):
-        pass
+        return self._local_path(path, self._retrieve_entry(path))
+
+    def _retrieve_entry(self, path, refresh=False):
+        # with refresh, the cached copy is known to be outdated
+        with self._lock:
+            before = self._files.get(path)
+        entry = None if refresh else self._lookup(path)
+        if entry is not None:
+            return entry
+        self.metrics.count("misses")
+        with self._lock:
+            current = self._files.get(path)
+            if current is not None and current is not before:
+                # another thread fetched the file after our lookup, and
+                # its flight is over already
+                self.metrics.count("coalesced")
+                return current
+            priority = self._scheduling()[0]
+            flight = self._inflight.get(path)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[path] = _Flight(priority)
+            else:
+                # a foreground retrieval must not wait for a prefetch
+                # at prefetch priority
+                flight.boost(priority)
+        if not leader:
+            self.metrics.count("coalesced")
+            return flight.wait()
+        start = timeit.default_timer()
+        outer = getattr(self._context, "flight", None)
+        self._context.flight = flight
+        try:
+            entry = self._fetch(path)
+        except BaseException as err:
+            self.metrics.count("fetch_errors")
+            flight.finish(error=err)
+            raise
+        else:
+            flight.finish(entry)
+        finally:
+            self._context.flight = outer
+            self.metrics.observe("fetch_seconds",
+                                 timeit.default_timer() - start)
+            with self._lock:
+                del self._inflight[path]
+        return entry
+
+    def open(self, path, lazy=True):
+        """Return a binary file object reading *path*
+
+        If *path* is cached, its cached copy is read; compressed files
+        are decompressed while they are read, without a copy in the
+        hot tier.  Otherwise, if *lazy* is true, a seekable file object
+        is returned which fetches only the blocks that are read into a
+        sparse local file; later reads of these blocks, from any file
+        object for *path*, are served locally.  If *lazy* is false,
+        the file is retrieved completely first.
+
+        """
+        with self._prefetcher.foreground():
+            entry = self._lookup(path)
+            if entry is None:
+                if lazy:
+                    self.metrics.count("misses")
+                    return self._open_sparse(path)
+                entry = self._retrieve_entry(path)
+        if entry.codec is None:
+            return io.open(entry.temppath, "rb")
+        return get_codec(entry.codec).open(entry.temppath)
+
+    def read(self, path):
+        """Return the contents of *path* as bytes
+
+        The file is retrieved first if need be.  With a memory tier,
+        the contents of frequently read files are served from memory;
+        wrap them in a :class:`memoryview` to slice them without
+        copying.
+
+        """
+        with self._lock:
+            self._held[path] += 1
+        try:
+            with self._prefetcher.foreground():
+                entry = self._retrieve_entry(path)
+            if self._memory is not None:
+                data = self._memory.get(path, entry)
+                if data is not None:
+                    self.metrics.count("memory_hits")
+                    return data
+            if entry.codec is None:
+                with io.open(entry.temppath, "rb") as fd:
+                    data = fd.read()
+            else:
+                with get_codec(entry.codec).open(entry.temppath) as fd:
+                    data = fd.read()
+            if self._memory is not None:
+                self._memory.put(path, entry, data)
+            return data
+        finally:
+            self._release(path)
+
+    def _open_sparse(self, path):
+        st = self._stat(path)
+        with self._lock:
+            state = replaced = self._sparse.get(path)
+            if state is None or _signature(state.st) != _signature(st):
+                state = self._sparse[path] = SparseState(
+                    os.path.join(self.temppath, SPARSE_DIRNAME, path), st,
+                    self.range_blocksize)
+            else:
+                replaced = None
+        if replaced is not None:
+            # the blocks of the old version are never read again; open
+            # file objects keep reading them from the unlinked file
+            remove(replaced.filename)
+        sourcepath = self._construct_sourcepath(path)
+
+        def _read_range(offset, length, write):
+            with self._transfer_slot():
+                self._read_range(sourcepath, offset, length, write)
+            self.metrics.count("bytes_fetched", length)
+        return SparseFile(
+            state, _read_range, self.readahead,
+            lambda state: self._promote_sparse(path, state))
+
+    def _promote_sparse(self, path, state):
+        """Turn the complete sparse file *state* into a cached file"""
+        with self._lock:
+            if self._sparse.get(path) is not state:
+                return
+            del self._sparse[path]
+        temppath = self._construct_temppath(path)
+        with self._fetch_lock(path):
+            self._prepare_targetpath(path)
+            os.chmod(state.filename, stat.S_IMODE(state.st.st_mode))
+            os.utime(state.filename, (state.st.st_atime, state.st.st_mtime))
+            os.rename(state.filename, temppath)
+            digest = None
+            if self._hashname is not None:
+                digest = hash_file(temppath, self._hashname)
+                if self.checksum:
+                    self._check_remote_checksum(path, temppath, digest)
+            if self._blobs is not None:
+                digest = self._blobs.add(temppath, digest)
+            stored = self._store(path)
+        self._register(path, state.time, state.st, digest, *stored)
+
+    def _remove_sparse(self, relpath):
+        with self._lock:
+            state = self._sparse.pop(relpath, None)
+        if state is not None:
+            try:
+                os.remove(state.filename)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+    def _local_path(self, path, entry):
+        """Return a local filename with the uncompressed contents of *entry*
+
+        Compressed entries are decompressed into the hot tier, unless
+        they are there already.
+
+        """
+        if entry.codec is None:
+            return entry.temppath
+        now = time.time()
+        with self._lock:
+            hotpath = self._hot_path(path)
+            if path in self._hot and os.path.exists(hotpath):
+                self._hot[path] = now
+                hotpath = None
+        if hotpath is not None:
+            self._decompress(entry, hotpath)
+            with self._lock:
+                self._hot[path] = now
+        self._expire_hot()
+        return self._hot_path(path)
+
+    def _hot_path(self, path):
+        with self._lock:
+            if self._hotdir is None:
+                makedirs(self.temppath)
+                self._hotdir = tempfile.mkdtemp(prefix=HOT_PREFIX,
+                                                dir=self.temppath)
+        return os.path.join(self._hotdir, path)
+
+    def _decompress(self, entry, hotpath):
+        makedirs(os.path.dirname(hotpath))
+        with publish(hotpath) as partpath:
+            with io.open(partpath, "wb") as fdst:
+                with get_codec(entry.codec).open(entry.temppath) as fsrc:
+                    shutil.copyfileobj(fsrc, fdst, 2**20)
+
+    def _drop_hot(self, path):
+        with self._lock:
+            if self._hot.pop(path, None) is None:
+                return
+            hotpath = self._hot_path(path)
+        try:
+            os.remove(hotpath)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def _expire_hot(self, force=False):
+        """Remove hot copies which were not retrieved for hot_ttl seconds
+
+        Unless *force* is true, the hot tier is scanned at most once
+        every hot_ttl / 2 seconds.
+
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._hot_expired < self.hot_ttl / 2:
+                return
+            self._hot_expired = now
+            expired = [path for path, accessed in self._hot.items()
+                       if now - accessed >= self.hot_ttl and
+                       path not in self._held]
+        for path in expired:
+            self._drop_hot(path)
+
+    def _codec_for(self, path):
+        """Return the codec and level to compress *path* with, or None"""
+        for pattern, codec, level in self._compression:
+            if fnmatch.fnmatch(path, pattern):
+                return None if codec is None else (codec, level)
+        return None
+
+    def _store(self, path):
+        """Compress the fetched copy of *path* if the rules say so
+
+        Returns the filename, the codec name (or None) and the size on
+        disk of the stored copy.  In shared mode, this must be called
+        under the fetch lock, so that other processes never see the
+        uncompressed copy.
+
+        """
+        temppath = self._construct_temppath(path)
+        compression = self._codec_for(path)
+        if compression is None:
+            return temppath, None, os.path.getsize(temppath)
+        size = os.path.getsize(temppath)
+        temppath = self._compress(path, *compression)
+        if self.shared:
+            # other processes adopt the compressed copy by the size of
+            # the source, which cannot be told from the copy itself
+            with publish(self._construct_lockpath(path, "stored")) as part:
+                with io.open(part, "w") as fd:
+                    fd.write("{} {}\n".format(compression[0].name, size))
+        return temppath, compression[0].name, os.path.getsize(temppath)
+
+    def _compress(self, path, codec, level):
+        """Compress the cached copy of *path* and return its new filename"""
+        temppath = self._construct_temppath(path)
+        target = temppath + codec.ext
+        with publish(target) as partpath:
+            codec.compress(temppath, partpath, level)
+            shutil.copystat(temppath, partpath)
+        os.remove(temppath)
+        return target
+
+    def _fetch(self, path):
+        # the fetch time is taken before the transfer starts, as the
+        # copy reflects the source at this time at the earliest
+        now = time.time()
+        with self._fetch_lock(path):
+            adopted = self._adopt(path) if self.shared else None
+            if adopted is None:
+                st, digest = self._transfer(path)
+                stored = self._store(path)
+            else:
+                st, stored = adopted
+                digest = None
+                if self._hashname is not None:
+                    digest = self._hash_copy(*stored[:2])
+                    if self._blobs is not None:
+                        self._blobs.add(stored[0], digest)
+        return self._register(path, now, st, digest, *stored)
+
+    def _fetch_lock(self, path):
+        """Return the lock serializing fetches of *path* across processes"""
+        if not self.shared:
+            return _null_context()
+        return FileLock(self._construct_lockpath(path, "fetch"))
+
+    def _register(self, path, now, st, digest, temppath, codec, disksize):
+        """Record the file of *path* fetched at *now* as cached
+
+        *st* is the stat result of the source and *digest* the digest
+        of the contents, if known; *temppath*, *codec* and *disksize*
+        describe the stored copy (see :meth:`_store`).
+
+        """
+        self._remove_sparse(path)
+        if self._memory is not None:
+            self._memory.discard(path)
+        size, mtime, ino = _signature(st)
+        entry = _Entry(temppath, datetime.datetime.fromtimestamp(now),
+                       size, mtime, ino, digest, codec)
+        self._drop_hot(path)
+        with self._lock:
+            old = self._files.get(path)
+            self._files[path] = entry
+            if old is not None and old.temppath != temppath:
+                try:
+                    os.remove(old.temppath)  # compressed differently
+                except OSError:
+                    pass
+            self._validated[path] = now
+            if digest is not None:
+                self._remember_digest(path, (size, mtime, ino), digest,
+                                      getattr(st, "st_dev", None))
+            if (old is not None and old.checksum not in (None, digest) and
+                    self._blobs is not None):
+                self._blobs.release(old.checksum)
+            if self._index is not None:
+                self._index.put(path, size, mtime, ino, now, digest, codec)
+            if self._eviction is not None:
+                self._eviction.add(path, disksize, now)
+                self._held[path] += 1
+                try:
+                    self.autoclean()
+                finally:
+                    self._release(path)
+        return entry
+
+    def _transfer(self, path):
+        """Retrieve *path* and return its source stat and digest
+
+        In content-addressed mode, the file is linked from the blob
+        store instead if its contents are known; otherwise, its
+        contents are added to the blob store.  The digest is None
+        unless the cache is content-addressed or in checksum mode.
+
+        """
+        temppath = self._construct_temppath(path)
+        if self._blobs is not None:
+            st = self._stat(path)
+            digest = self._known_digest(path, _signature(st),
+                                        getattr(st, "st_dev", None))
+            if digest is not None and self._blobs.has(digest):
+                self._prepare_targetpath(path)
+                self._blobs.link(digest, temppath)
+                return st, digest
+        if self._hashname is None:
+            with self._transfer_slot():
+                st, nbytes = self._retrieve(path)
+            self.metrics.count("bytes_fetched", nbytes)
+            return st, None
+        hasher = Hasher(self._hashname)
+        with self._transfer_slot():
+            st, nbytes = self._retrieve(path, hasher)
+        self.metrics.count("bytes_fetched", nbytes)
+        digest = hasher.hexdigest()
+        if self.checksum:
+            self._check_remote_checksum(path, temppath, digest)
+        if self._blobs is not None:
+            self._blobs.add(temppath, digest)
+        return st, digest
+
+    def _scheduling(self):
+        """Return the priority and the caller of this thread's transfers
+
+        The transfers of a flight run with its priority, if that is
+        more urgent.
+
+        """
+        priority = getattr(self._context, "priority", "foreground")
+        flight = getattr(self._context, "flight", None)
+        if flight is not None and (PRIORITIES.index(flight.priority) <
+                                   PRIORITIES.index(priority)):
+            priority = flight.priority
+        return (priority, getattr(self._context, "caller", None) or
+                threading.current_thread().ident)
+
+    @contextlib.contextmanager
+    def _scheduled(self, priority=None, caller=None):
+        """Run the ``with`` block's transfers as *priority* for *caller*"""
+        old = self._scheduling()
+        self._context.priority = priority or old[0]
+        self._context.caller = caller or old[1]
+        try:
+            yield
+        finally:
+            self._context.priority, self._context.caller = old
+
+    def _in_context(self, func, priority=None):
+        """Wrap *func* to run with the scheduling of the calling thread
+
+        This is for functions run by worker threads on behalf of the
+        calling thread.
+
+        """
+        context = self._scheduling()
+        flight = getattr(self._context, "flight", None)
+
+        def _call(*args, **kwargs):
+            outer = getattr(self._context, "flight", None)
+            self._context.flight = flight
+            try:
+                with self._scheduled(priority or context[0], context[1]):
+                    return func(*args, **kwargs)
+            finally:
+                self._context.flight = outer
+        return _call
+
+    def _transfer_slot(self):
+        if self.scheduler is None:
+            return _null_context()
+        priority, caller = self._scheduling()
+        return self.scheduler.slot(self._transfer_host(), priority, caller)
+
+    def _throttle(self, nbytes):
+        """Wait until *nbytes* may be transferred
+
+        Backends call this before transferring each piece of data.
+
+        """
+        if self.scheduler is not None:
+            priority, caller = self._scheduling()
+            self.scheduler.consume(nbytes, priority, caller)
+
+    def _transfer_host(self):
+        """Return the name of the host files are transferred from"""
+        return "localhost"
+
+    def _check_remote_checksum(self, path, temppath, digest):
+        """Remove *temppath* and raise if *digest* is not the remote one"""
+        remote = self._remote_checksum(path, self._hashname)
+        if remote is not None and remote != digest:
+            os.remove(temppath)
+            raise IOError(errno.EIO, "Checksum mismatch: the {} of the copy "
+                          "is {}, the source has {}".format(
+                              self._hashname, digest, remote), path)
+
+    def _known_digest(self, path, signature, dev=None):
+        with self._lock:
+            known = self._digests.get(path)
+            if known is not None and known[0] == signature:
+                return known[1]
+            if dev is not None and signature[2] is not None:
+                return self._contents.get((dev,) + signature)
+        return None
+
+    def _remember_digest(self, path, signature, digest, dev=None):
+        with self._lock:
+            self._digests[path] = signature, digest
+            if dev is not None and signature[2] is not None:
+                # the same source device, inode, size and mtime means
+                # the same contents, whichever path it is reached by;
+                # inode numbers are only unique on one device
+                self._contents[(dev,) + signature] = digest
+
+    def _construct_lockpath(self, path, kind):
+        lockdir = os.path.join(self.temppath, LOCKS_DIRNAME)
+        if not os.path.isdir(lockdir):
+            self._prepare_targetpath(os.path.join(LOCKS_DIRNAME, "lock"))
+        return os.path.join(lockdir, "{}.{}".format(
+            hashlib.sha1(path.encode("utf-8")).hexdigest(), kind))
+
+    def _adopt(self, path):
+        """Return the source stat and the stored copy of *path*, if current
+
+        This is used in shared mode, to pick up files which another
+        process retrieved; the copy is described like by :meth:`_store`.
+        Compressed copies are checked against the size of the source
+        recorded when they were stored.  Returns None if *path* has to
+        be fetched.
+
+        """
+        temppath = self._construct_temppath(path)
+        compression = self._codec_for(path)
+        codec = None if compression is None else compression[0].name
+        if codec is not None:
+            temppath += compression[0].ext
+        try:
+            local = os.stat(temppath)
+            size = local.st_size
+            if codec is not None:
+                with io.open(self._construct_lockpath(path, "stored")) as fd:
+                    name, size = fd.read().split()
+                if name != codec:
+                    return None
+                size = int(size)
+        except (IOError, OSError, ValueError):
+            return None
+        st = self._stat(path)
+        if (size == st.st_size and
+                abs(local.st_mtime - st.st_mtime) < 1e-3):
+            return st, (temppath, codec, local.st_size)
+        return None
+
+    def _lookup(self, path):
+        """Return the entry of *path* if its cached copy can be served
+
+        Depending on :attr:`validate`, this stats the source at most
+        once; it never touches the cached copy itself.  Returns None
+        if *path* has to be fetched.
+
+        """
+        with self._lock:
+            entry = self._files.get(path)
+            validated = self._validated.get(path, 0)
+        if entry is None:
+            return None
+        if self.shared and not os.path.exists(entry.temppath):
+            return None  # removed by another process
+        now = time.time()
+        if self.validate == "always" or (
+                self.validate != "never" and
+                now - validated >= self.validate):
+            try:
+                st = self._stat(path)
+            except (IOError, OSError):
+                return None
+            if _signature(st) != (entry.size, entry.mtime, entry.ino):
+                return None
+        with self._lock:
+            if self._files.get(path) is not entry:
+                return None  # evicted or replaced in the meantime
+            if self.validate != "never":
+                self._validated[path] = now
+            if self._index is not None:
+                self._index.touch(path)
+            if self._eviction is not None:
+                self._eviction.access(path)
+        self.metrics.count("hits")
+        self.metrics.count("bytes_served", entry.size)
+        return entry
+
+    def _retrieve(self, path, hasher=None):
+        """Copy *path* to local storage
+
+        Returns the stat of its source and the number of bytes
+        transferred, which is less than its size if only a part had to
+        be fetched.  If *hasher* is given, the data is passed to its ``update``
+        method while it is transferred (see :class:`Hasher`).
+
+        """
+        raise NotImplementedError()
+
+    def _stat(self, path):
+        """Return the stat result of *path* on the remote storage"""
+        raise NotImplementedError()
+
+    def _read_range(self, sourcepath, offset, length, write):
+        """Read *length* bytes at *offset* of the source *sourcepath*
+
+        The data is passed to ``write(position, data)``, in one or more
+        pieces.
+
+        """
+        raise NotImplementedError()
+
+    def _remote_checksum(self, path, hashname):
+        """Return the checksum of the source of *path*, or None
+
+        This reads the sidecar file named like *path* with *hashname*
+        as an additional extension, if there is one.
+
+        """
+        sidecar = "{}.{}".format(path, hashname)
+        if self._metadata.mode(sidecar) is None:
+            return None
+        chunks = []
+        self._read_range(self._construct_sourcepath(sidecar), 0,
+                         min(self._stat(sidecar).st_size, 4096),
+                         lambda pos, data: chunks.append(data))
+        fields = b"".join(chunks).split()
+        return fields[0].decode("ascii").lower() if fields else None
+
+    def _listdir_stat(self, dirname):
+        """Return the stat results of the entries of *dirname*
+
+        Returns a dict mapping the names of the entries of the remote
+        directory *dirname* to their stat results, following symlinks,
+        or to None if they cannot be stat'ed.
+
+        """
+        result = {}
+        for name in self._scandir(dirname)[1]:
+            try:
+                result[name] = self._stat(normpath(os.path.join(dirname,
+                                                                name)))
+            except (IOError, OSError):
+                result[name] = None
+        return result
+
+    def _scandir(self, dirname):
+        """List *dirname* on the remote storage
+
+        Returns the mtime of *dirname* and a dict mapping the names of
+        its entries to their ``st_mode``, or to None if the mode is
+        not known without another request.
+
+        """
+        raise NotImplementedError()
 
     def clean(self, pattern=None, time=None):
         """Selectively clean local storage
@@ -94,6 +1118,14 @@ class FilesystemCache(object):
         datetime.datetime or a datetime.timedelta object).
 
         """
+        start = timeit.default_timer()
+        try:
+            self._clean(pattern, time)
+        finally:
+            self.metrics.observe("clean_seconds",
+                                 timeit.default_timer() - start)
+
+    def _clean(self, pattern, time):
         if pattern is None:
             pattern = "*"
         files_to_clean = glob.glob(os.path.join(self.temppath, pattern))
@@ -105,40 +1137,502 @@ class FilesystemCache(object):
         else:
             t_constraint = lambda t: False
 
-        def _remove_file(relpath, abspath):
-            os.remove(abspath)
-            self._files.pop(relpath)
-            if len(os.listdir(os.path.dirname(abspath))) == 0:
-                shutil.rmtree(os.path.dirname(abspath))
-
         def _check_time_constraint(time, t):
             return time is None or (t_constraint(t) and time is not None)
 
-        # iterate over local files and delete if necessary
-        for relpath, (abspath, t) in self._files.items():
-            if abspath in files_to_clean:
+        # iterate over local files and delete if necessary; compressed
+        # files are matched by their uncompressed name as well
+        fullpattern = os.path.join(self.temppath, pattern)
+        for relpath, (abspath, t) in self._iter_files():
+            uncompressed = self._construct_temppath(relpath)
+            if abspath in files_to_clean or (
+                    abspath != uncompressed and
+                    fnmatch.fnmatch(uncompressed, fullpattern)):
                 if _check_time_constraint(time, t):
-                    _remove_file(relpath, abspath)
+                    self._remove(relpath)
 
         # iterate over files_to_clean; if it's a directory, delete this
         for f in files_to_clean:
             if os.path.isdir(f):
-                for relpath, (abspath, t) in self._files.items():
+                for relpath, (abspath, t) in self._iter_files():
                     if abspath.startswith(f):
                         if _check_time_constraint(time, t):
-                            _remove_file(relpath, abspath)
+                            self._remove(relpath)
+
+        # sparse files are matched by the name of their cached copy
+        with self._lock:
+            sparse = list(self._sparse.items())
+        for relpath, state in sparse:
+            if _match_path(self._construct_temppath(relpath), fullpattern):
+                t = datetime.datetime.fromtimestamp(state.time)
+                if _check_time_constraint(time, t):
+                    self._remove_sparse(relpath)
+
+        # so are the sparse files left behind by other processes,
+        # unless these still use them
+        with self._lock:
+            live = set(state.filename for state in self._sparse.values())
+        for relpath, filename in iter_sparse_files(
+                os.path.join(self.temppath, SPARSE_DIRNAME)):
+            if filename in live or not _match_path(
+                    self._construct_temppath(relpath), fullpattern):
+                continue
+            try:
+                t = datetime.datetime.fromtimestamp(
+                    os.path.getmtime(filename))
+            except OSError:
+                continue
+            if _check_time_constraint(time, t):
+                remove_unused(filename)
+
+        # partial downloads left behind by failed or abandoned
+        # transfers are matched by the name of their cached copy
+        for relpath, partpath in self._iter_partial():
+            if not _match_path(self._construct_temppath(relpath),
+                               fullpattern):
+                continue
+            try:
+                t = datetime.datetime.fromtimestamp(
+                    os.path.getmtime(partpath))
+            except OSError:
+                continue
+            if _check_time_constraint(time, t):
+                self._remove_partial(relpath, partpath)
+
+        self._expire_hot(force=True)
+
+    def _iter_partial(self):
+        """Return a list of (relpath, partpath) of partial downloads
+
+        Backends which resume interrupted transfers leave their partial
+        downloads on disk; this lists them with the relative path they
+        belong to, so that :meth:`clean` can sweep them.
+
+        """
+        return []
+
+    def _remove_partial(self, relpath, partpath):
+        """Remove the partial download *partpath* unless it is in use
+
+        A partial download is in use while *relpath* is being fetched,
+        by this or, in shared mode, any other process.
+
+        """
+        with self._lock:
+            if relpath in self._inflight:
+                return False
+            lock = None
+            if self.shared:
+                lock = FileLock(self._construct_lockpath(relpath, "fetch"))
+                if not lock.acquire(blocking=False):
+                    return False
+            try:
+                remove(partpath)
+            finally:
+                if lock is not None:
+                    lock.release()
+        return True
+
+    def _remove(self, relpath):
+        """Remove *relpath* from local storage and all bookkeeping
+
+        Files which are held, or leased by any process in shared mode,
+        are left alone.  Returns whether the file was removed.
+
+        """
+        with self._lock:
+            if relpath not in self._files or relpath in self._held:
+                return False
+            lease = None
+            if self.shared:
+                lease = FileLock(self._construct_lockpath(relpath, "lease"))
+                if not lease.acquire(blocking=False):
+                    return False
+            try:
+                entry = self._files.pop(relpath)
+                self._validated.pop(relpath, None)
+                if self._index is not None:
+                    self._index.remove(relpath)
+                if self._eviction is not None:
+                    self._eviction.remove(relpath)
+                try:
+                    os.remove(entry.temppath)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:  # removed by another process
+                        raise
+                if self._blobs is not None and entry.checksum is not None:
+                    self._blobs.release(entry.checksum)
+                self._drop_hot(relpath)
+                if self._memory is not None:
+                    self._memory.discard(relpath)
+            finally:
+                if lease is not None:
+                    lease.release()
+        dirname = os.path.dirname(entry.temppath)
+        if os.path.normpath(dirname) != os.path.normpath(self.temppath):
+            try:
+                os.rmdir(dirname)  # only succeeds if it is empty
+            except OSError:
+                pass
+        return True
+
+    def _iter_files(self):
+        with self._lock:
+            return [(relpath, entry[:2])
+                    for relpath, entry in list(self._files.items())]
+
+    def sync(self, subtree=".", pattern=None, delete=False):
+        """Mirror the remote directory *subtree* into the cache
+
+        All regular files below *subtree*, or those whose path relative
+        to *subtree* matches the glob pattern *pattern*, are compared
+        with their cached copies by size, mtime and inode, and new or
+        changed files are retrieved by up to :attr:`workers` threads.
+        The remote tree is listed directly, one request per directory,
+        bypassing the metadata cache.  If *delete* is true, cached
+        files below *subtree* (and matching *pattern*) which no longer
+        exist remotely are removed.
+
+        Returns the relative paths of the retrieved files.  Failures
+        are raised together as a :class:`RetrieveError`, whose
+        *results* hold these relative paths, with None for the failed
+        ones.
+
+        """
+        subtree = normpath(subtree)
+        files = {}
+        pending = [subtree]
+        while pending:
+            dirname = pending.pop()
+            for name, st in self._listdir_stat(dirname).items():
+                if st is None:
+                    continue
+                path = normpath(os.path.join(dirname, name))
+                if stat.S_ISDIR(st.st_mode):
+                    pending.append(path)
+                elif stat.S_ISREG(st.st_mode) and (
+                        pattern is None or fnmatch.fnmatch(
+                            os.path.relpath(path, subtree), pattern)):
+                    files[path] = st
+        now = time.time()
+        changed = []
+        with self._lock:
+            for path in sorted(files):
+                entry = self._files.get(path)
+                if (entry is not None and
+                        (entry.size, entry.mtime, entry.ino) ==
+                        _signature(files[path]) and
+                        not (self.shared and
+                             not os.path.exists(entry.temppath))):
+                    self._validated[path] = now
+                else:
+                    changed.append(path)
+        if delete:
+            with self._lock:
+                cached = list(self._files)
+            for path in cached:
+                relpath = os.path.relpath(path, subtree)
+                outside = relpath == os.pardir or relpath.startswith(
+                    os.pardir + os.sep)
+                if path not in files and not outside and (
+                        pattern is None or fnmatch.fnmatch(relpath, pattern)):
+                    self._remove(path)
+
+        def _sync(path):
+            try:
+                self._retrieve_entry(path, refresh=True)
+                return path, None
+            except Exception as err:
+                return None, err
+        _sync = self._in_context(_sync, "sync")
+        with self._prefetcher.foreground():
+            if self.workers > 1 and len(changed) > 1:
+                outcomes = self._get_pool().map(_sync, changed)
+            else:
+                outcomes = [_sync(path) for path in changed]
+        errors = collections.OrderedDict(
+            (p, err) for p, (_, err) in zip(changed, outcomes)
+            if err is not None)
+        retval = [result for result, _ in outcomes]
+        if errors:
+            raise RetrieveError(errors, retval)
+        return retval
+
+    def stats(self):
+        """Return a snapshot of the metrics of the cache
+
+        Besides the counters and histograms of :meth:`Metrics.snapshot`,
+        this holds the ``backend`` class name, the number of cached
+        ``files``, the number of transfers in flight (``inflight``),
+        the bytes held by the memory tier (``memory_bytes``), and the
+        ``fetch_throughput`` in bytes per second of fetch time.
+
+        """
+        snapshot = self.metrics.snapshot()
+        with self._lock:
+            snapshot["files"] = len(self._files)
+            snapshot["inflight"] = len(self._inflight)
+        snapshot["memory_bytes"] = (
+            0 if self._memory is None else self._memory.nbytes)
+        seconds = snapshot["fetch_seconds"]["sum"]
+        snapshot["fetch_throughput"] = (
+            snapshot["bytes_fetched"] / seconds if seconds else 0.)
+        snapshot["backend"] = type(self).__name__
+        return snapshot
+
+    def verify(self, path=None):
+        """Check cached files against their recorded checksums
+
+        *path* is a relative path, a glob pattern matched against the
+        cached paths, or an iterable of paths; by default, all cached
+        files are checked.  The files are hashed in parallel by up to
+        :attr:`workers` threads.  Files which don't match their
+        checksum are removed from the cache, unless they are held, and
+        their relative paths are returned.  Files without a checksum
+        are skipped.
+
+        """
+        with self._lock:
+            if path is None:
+                paths = list(self._files)
+            elif isinstance(path, basestring):
+                paths = (fnmatch.filter(self._files, path)
+                         if _MAGIC.search(path) else [path])
+            else:
+                paths = list(path)
+            entries = [(p, self._files[p]) for p in paths
+                       if p in self._files and
+                       self._files[p].checksum is not None]
+        if self.workers > 1 and len(entries) > 1:
+            results = self._get_pool().map(self._verify_entry, entries)
+        else:
+            results = [self._verify_entry(entry) for entry in entries]
+        corrupt = [p for (p, _), ok in zip(entries, results) if not ok]
+        for p in corrupt:
+            self._remove(p)
+        return corrupt
+
+    def _verify_entry(self, item):
+        path, entry = item
+        try:
+            digest = self._hash_copy(entry.temppath, entry.codec)
+        except (IOError, OSError):
+            return False
+        return digest == entry.checksum
+
+    def _hash_copy(self, temppath, codec):
+        """Return the digest of the contents of the stored *temppath*"""
+        if codec is None:
+            return hash_file(temppath, self._hashname)
+        with get_codec(codec).open(temppath) as fd:
+            return hash_fileobj(fd, self._hashname)
+
+    @contextlib.contextmanager
+    def hold(self, path):
+        """Retrieve *path* and protect it from eviction
+
+        This is a context manager yielding the local filename(s);
+        the files are not removed until the ``with`` block is left::
+
+            with cache.hold("data.nc") as filename:
+                process(filename)
+
+        In shared mode, the files are leased, so that other processes
+        don't remove them either.
+
+        """
+        single = isinstance(path, basestring) and not _MAGIC.search(path)
+        if single:
+            paths = [path]
+        elif isinstance(path, basestring):
+            # the matches are held, not the pattern
+            paths = self._expand(path)
+        else:
+            paths = list(path)
+        leases = []
+        with self._lock:
+            for p in paths:
+                self._held[p] += 1
+        try:
+            if self.shared:
+                for p in paths:
+                    lease = FileLock(self._construct_lockpath(p, "lease"),
+                                     shared=True)
+                    lease.acquire()
+                    leases.append(lease)
+            yield self.retrieve(path if single else paths)
+        finally:
+            for lease in leases:
+                lease.release()
+            for p in paths:
+                self._release(p)
+
+    @contextlib.contextmanager
+    def mmap(self, path, offset=0, length=None, dtype=None):
+        """Map the cached copy of *path* into memory, read-only
+
+        This is a context manager, which retrieves *path* if need be
+        and yields a read-only memoryview of *length* bytes (default:
+        up to the end) from *offset* of the file, without copying it::
+
+            with cache.mmap("data.raw", dtype="<f4") as array:
+                total = array.sum()
+
+        If *dtype* is given, a read-only NumPy array of that type over
+        the mapped bytes is yielded instead.  Like with :meth:`hold`,
+        the file cannot be removed while it is mapped.  References to
+        the view must not be used after the ``with`` block.
+
+        """
+        if dtype is not None:
+            # imported here, as importing numpy takes a while
+            try:
+                import numpy
+            except ImportError:
+                raise ImportError("Cannot import numpy, which is needed "
+                                  "for mapping files as arrays")
+        with self.hold(path) as filename:
+            with io.open(filename, "rb") as fd:
+                size = os.fstat(fd.fileno()).st_size
+                if not 0 <= offset <= size:
+                    raise ValueError("Offset {} is outside of '{}', which "
+                                     "has {} bytes".format(offset, path, size))
+                if length is None or offset + length > size:
+                    length = size - offset
+                if not length:
+                    # empty ranges can't be mapped
+                    yield (memoryview(b"") if dtype is None else
+                           numpy.empty(0, dtype))
+                    return
+                # mappings start at a multiple of the allocation granularity
+                start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                mapping = mmap.mmap(fd.fileno(), offset - start + length,
+                                    access=mmap.ACCESS_READ, offset=start)
+            view = None
+            try:
+                if dtype is not None:
+                    dtype = numpy.dtype(dtype)
+                    yield numpy.frombuffer(mapping, dtype,
+                                           length // dtype.itemsize,
+                                           offset - start)
+                else:
+                    try:
+                        view = memoryview(mapping)[offset - start:]
+                    except TypeError:  # Python 2 mmaps have no new buffers
+                        view = buffer(mapping, offset - start)
+                    yield view
+            finally:
+                if hasattr(view, "release"):
+                    view.release()
+                try:
+                    mapping.close()
+                except BufferError:
+                    pass  # still exported by an array; closed when collected
+
+    def _release(self, path):
+        with self._lock:
+            self._held[path] -= 1
+            if self._held[path] <= 0:
+                del self._held[path]
+
+    def _over_capacity(self):
+        if self.max_bytes is not None and \
+                self._eviction.nbytes > self.max_bytes:
+            return True
+        if self.max_files is not None and \
+                len(self._eviction) > self.max_files:
+            return True
+        if self.min_free is not None:
+            st = os.statvfs(self.temppath)
+            if st.f_bavail * st.f_frsize < self.min_free:
+                return True
+        return False
 
     def autoclean(self):
-        raise NotImplementedError()
+        """Evict files until the cache is within its size limits
+
+        Returns the relative paths of the evicted files.  This is
+        called automatically after every retrieval.
+
+        """
+        evicted = []
+        if self._eviction is None:
+            return evicted
+        leased = []
+        with self._lock:
+            while self._over_capacity():
+                path = self._eviction.pop(skip=self._held)
+                if path is None:
+                    warnings.warn("Cannot evict enough files to satisfy "
+                                  "the cache limits, all remaining files "
+                                  "are in use")
+                    break
+                if self._remove(path):
+                    evicted.append(path)
+                else:
+                    leased.append(path)
+            # files leased by other processes stay evictable later on
+            for path in leased:
+                if path in self._files:
+                    self._eviction.add(path, self._files[path].size)
+        if evicted:
+            self.metrics.count("evictions", len(evicted))
+        return evicted
 
     def glob(self, pathname):
-        raise NotImplementedError()
+        """Return the source paths matching the pattern *pathname*
+
+        The pattern is matched against the cached directory listings,
+        listing each directory at most once.  Like :func:`glob.glob`,
+        wildcards don't match names starting with a dot.
+
+        """
+        return [self._construct_sourcepath(p) for p in self._glob(pathname)]
+
+    def _expand(self, pathname):
+        """Return the relative paths of the files matching *pathname*
+
+        Unlike :meth:`glob`, this leaves out directories, so that the
+        result can be retrieved.
+
+        """
+        return [path for path in self._glob(pathname)
+                if stat.S_ISREG(self._metadata.mode(path) or 0)]
+
+    def _glob(self, pathname):
+        parts = [part for part in normpath(pathname).split(os.sep)
+                 if part not in ("", ".")]
+        candidates = ["."]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            matches = []
+            for dirname in candidates:
+                if _MAGIC.search(part):
+                    try:
+                        modes = self._metadata.listdir(dirname)
+                    except (IOError, OSError):
+                        continue
+                    names = [name for name in fnmatch.filter(modes, part)
+                             if part.startswith(".") or
+                             not name.startswith(".")]
+                else:
+                    names = [part]
+                for name in names:
+                    path = normpath(os.path.join(dirname, name))
+                    mode = self._metadata.mode(path)
+                    if mode is None or not (last or stat.S_ISDIR(mode)):
+                        continue
+                    matches.append(path)
+            candidates = matches
+        return sorted(candidates) if parts else []
 
     def isdir(self, dirname):
-        raise NotImplementedError()
+        mode = self._metadata.mode(dirname)
+        return mode is not None and stat.S_ISDIR(mode)
 
     def isfile(self, filename):
-        raise NotImplementedError()
+        mode = self._metadata.mode(filename)
+        return mode is not None and stat.S_ISREG(mode)
 
     def listdir(self, dirname):
-        raise NotImplementedError()
+        return list(self._metadata.listdir(dirname))
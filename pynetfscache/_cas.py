@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import errno
+import hashlib
+import io
+import os
+
+try:
+    import xxhash
+    _XXHASH = True
+except ImportError:
+    _XXHASH = False
+
+try:
+    import blake3
+    _BLAKE3 = True
+except ImportError:
+    _BLAKE3 = False
+
+from ._files import makedirs, publish
+
+
+BLOBS_DIRNAME = ".pynetfscache.blobs"
+
+
+def default_hashname():
+    """Return the name of the fastest available hash function"""
+    if _XXHASH:
+        return "xxh128"
+    if _BLAKE3:
+        return "blake3"
+    return "sha1"
+
+
+def new_hash(name):
+    """Return a new hash object for the hash function *name*
+
+    Besides the functions of :mod:`hashlib`, ``"xxh128"`` and
+    ``"blake3"`` are supported if the xxhash and blake3 packages are
+    installed.
+
+    """
+    if name == "xxh128":
+        if not _XXHASH:
+            raise ImportError("Cannot import xxhash, which is needed for "
+                              "the xxh128 hash")
+        return xxhash.xxh3_128()
+    if name == "blake3":
+        if not _BLAKE3:
+            raise ImportError("Cannot import blake3, which is needed for "
+                              "the blake3 hash")
+        return blake3.blake3()
+    return hashlib.new(name)
+
+
+class Hasher(object):
+    """The hash of a stream, under the hash function *name*
+
+    Backends feed the data they transfer to :meth:`update`; if they
+    start a stream over, e.g. to retry a transfer, they call
+    :meth:`reset` first.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self._hash = new_hash(self.name)
+
+    def update(self, data):
+        self._hash.update(data)
+
+    def restart(self, filename):
+        """Start the stream over with the contents of *filename*"""
+        self.reset()
+        with io.open(filename, "rb") as fd:
+            for block in iter(lambda: fd.read(2**20), b""):
+                self.update(block)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+def hash_fileobj(fileobj, name, blocksize=2**20):
+    """Return the hex digest of what is read from *fileobj*"""
+    h = new_hash(name)
+    for block in iter(lambda: fileobj.read(blocksize), b""):
+        h.update(block)
+    return h.hexdigest()
+
+
+def hash_file(filename, name, blocksize=2**20):
+    """Return the hex digest of the contents of *filename*"""
+    h = new_hash(name)
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with io.open(filename, "rb", buffering=0) as fd:
+        while True:
+            n = fd.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+class BlobStore(object):
+    """A content-addressed store of files, keyed by their hash
+
+    Blobs live in *root*, named by the hex digest of their contents
+    under the hash function *hashname*.  Cached files are hardlinks
+    to the blobs, so identical files are stored once.  A blob which
+    is linked by no cached file anymore is removed by
+    :meth:`release`.
+
+    """
+
+    def __init__(self, root, hashname=None):
+        self.root = root
+        self.hashname = hashname or default_hashname()
+        new_hash(self.hashname)  # fail early for unknown hash functions
+
+    def blobpath(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.isfile(self.blobpath(digest))
+
+    def add(self, filename, digest=None):
+        """Store the contents of *filename* and return their digest
+
+        If the contents are stored already, *filename* is replaced by
+        a link to the existing blob.
+
+        """
+        if digest is None:
+            digest = hash_file(filename, self.hashname)
+        blobpath = self.blobpath(digest)
+        makedirs(os.path.dirname(blobpath))
+        try:
+            os.link(filename, blobpath)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+            self.link(digest, filename)
+        return digest
+
+    def link(self, digest, filename):
+        """Atomically make *filename* a link to the blob *digest*"""
+        with publish(filename) as partpath:
+            os.remove(partpath)
+            os.link(self.blobpath(digest), partpath)
+
+    def release(self, digest):
+        """Remove the blob *digest* if no cached file links to it"""
+        blobpath = self.blobpath(digest)
+        try:
+            if os.stat(blobpath).st_nlink <= 1:
+                os.remove(blobpath)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
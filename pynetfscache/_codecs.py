@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""Compression codecs for cached files
+
+A codec is registered with :func:`register_codec` under a name, with
+the extension of its files, a function compressing one file into
+another at a given level, and a function opening a compressed file
+as a readable binary file object.  ``gzip`` and ``bz2`` are always
+available, ``xz`` with the lzma module, ``zstd`` with the zstandard
+package, and ``lz4`` with the lz4 package; these modules are imported
+on first use.
+
+"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import bz2
+import collections
+import gzip
+import importlib
+import io
+import shutil
+
+
+_BUFSIZE = 2**20
+
+Codec = collections.namedtuple("Codec", ["name", "ext", "default_level",
+                                         "compress", "open"])
+
+_CODECS = {}
+
+# the modules needed by codecs, which are imported on first use
+_REQUIRES = {"xz": "lzma", "zstd": "zstandard", "lz4": "lz4.frame"}
+
+
+def register_codec(name, ext, default_level, compress, open):
+    """Register a codec
+
+    ``compress(src, dst, level)`` compresses the file *src* into the
+    file *dst*, ``open(filename)`` returns a readable binary file
+    object with the decompressed contents of *filename*.
+
+    """
+    _CODECS[name] = Codec(name, ext, default_level, compress, open)
+
+
+def _require(name):
+    """Import and return the module needed by the codec *name*"""
+    module = _REQUIRES[name]
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError("Cannot import {}, which is needed for the {} "
+                          "codec".format(module.split(".")[0], name))
+
+
+def get_codec(name):
+    if name not in _CODECS:
+        raise ValueError("Unknown compression codec '{}', use one of "
+                         "{}".format(name, ", ".join(sorted(_CODECS))))
+    if name in _REQUIRES:
+        _require(name)  # fail early if the module is missing
+    return _CODECS[name]
+
+
+def _compress_stream(compressor, src, dst):
+    with io.open(src, "rb") as fsrc, io.open(dst, "wb") as fdst:
+        for block in iter(lambda: fsrc.read(_BUFSIZE), b""):
+            fdst.write(compressor.compress(block))
+        fdst.write(compressor.flush())
+
+
+def _gzip_compress(src, dst, level):
+    with io.open(src, "rb") as fsrc, \
+            gzip.GzipFile(dst, "wb", compresslevel=level) as fdst:
+        shutil.copyfileobj(fsrc, fdst, _BUFSIZE)
+
+
+def _gzip_open(filename):
+    return gzip.GzipFile(filename, "rb")
+
+
+def _bz2_compress(src, dst, level):
+    _compress_stream(bz2.BZ2Compressor(level), src, dst)
+
+
+def _bz2_open(filename):
+    return bz2.BZ2File(filename, "rb")
+
+
+def _xz_compress(src, dst, level):
+    _compress_stream(_require("xz").LZMACompressor(preset=level), src, dst)
+
+
+def _xz_open(filename):
+    return _require("xz").open(filename, "rb")
+
+
+def _zstd_compress(src, dst, level):
+    compressor = _require("zstd").ZstdCompressor(level=level)
+    with io.open(src, "rb") as fsrc, io.open(dst, "wb") as fdst:
+        compressor.copy_stream(fsrc, fdst)
+
+
+def _zstd_open(filename):
+    return _require("zstd").ZstdDecompressor().stream_reader(
+        io.open(filename, "rb"), closefd=True)
+
+
+def _lz4_compress(src, dst, level):
+    with io.open(src, "rb") as fsrc, \
+            _require("lz4").open(dst, "wb",
+                                 compression_level=level) as fdst:
+        shutil.copyfileobj(fsrc, fdst, _BUFSIZE)
+
+
+def _lz4_open(filename):
+    return _require("lz4").open(filename, "rb")
+
+
+register_codec("gzip", ".gz", 6, _gzip_compress, _gzip_open)
+register_codec("bz2", ".bz2", 9, _bz2_compress, _bz2_open)
+register_codec("xz", ".xz", 6, _xz_compress, _xz_open)
+register_codec("zstd", ".zst", 3, _zstd_compress, _zstd_open)
+register_codec("lz4", ".lz4", 0, _lz4_compress, _lz4_open)
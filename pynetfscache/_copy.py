@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""Copy files between file descriptors with the cheapest available means
+
+The mechanisms are tried in this order:
+
+1. a ``FICLONE`` reflink (Btrfs, XFS), which shares the data blocks
+   instead of copying them,
+2. ``copy_file_range``, copying in the kernel (or server-side on NFS
+   4.2),
+3. ``sendfile``, copying in the kernel,
+4. a ``readinto`` loop with a reusable buffer of *blocksize* bytes.
+
+If the copied data is to be hashed on the way, only the last one is
+used, as it is the only one passing the data through user space.  If
+the copy is throttled, reflinks are skipped, and the others copy
+pieces of *blocksize* bytes, each after a call to the throttle.
+
+Which of these exist depends on the platform and Python version; a
+mechanism that is not supported for a pair of files is skipped.
+
+"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import errno
+import io
+import os
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+COPY_BUFSIZE = 2**20
+
+# _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning that a mechanism is not supported for these files
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ["ENOSYS", "EXDEV", "EINVAL", "EOPNOTSUPP", "ENOTSUP",
+                    "ENOTTY", "EBADF", "EPERM"] if hasattr(errno, name))
+
+# largest count passed to a single copy_file_range/sendfile call
+_MAX_CHUNK = 2**30
+
+
+def _fadvise(fd, advice):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def preallocate(fd, size):
+    """Allocate *size* bytes for the file *fd*, sparsely if need be"""
+    if hasattr(os, "posix_fallocate") and size > 0:
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # not supported by the filesystem
+    os.ftruncate(fd, size)
+
+
+def pwrite(fd, data, offset):
+    """Write *data* to *fd* at *offset*"""
+    if hasattr(os, "pwrite"):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+    else:
+        # fallback for Python 2; the fd must not be shared between threads
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+
+def _reflink(fsrc, fdst):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(fdst, FICLONE, fsrc)
+    except (IOError, OSError) as err:
+        if err.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _copy_file_range(fsrc, fdst, offset, size, chunk=_MAX_CHUNK,
+                     throttle=None):
+    while offset < size:
+        count = min(size - offset, chunk)
+        if throttle is not None:
+            throttle(count)
+        copied = os.copy_file_range(fsrc, fdst, count, offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+    return offset
+
+
+def _sendfile(fsrc, fdst, offset, size, chunk=_MAX_CHUNK, throttle=None):
+    os.lseek(fdst, offset, os.SEEK_SET)
+    while offset < size:
+        count = min(size - offset, chunk)
+        if throttle is not None:
+            throttle(count)
+        copied = os.sendfile(fdst, fsrc, offset, count)
+        if copied == 0:
+            break
+        offset += copied
+    return offset
+
+
+def _readinto(fsrc, fdst, offset, size, blocksize, hasher=None,
+              throttle=None):
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    reader = io.FileIO(fsrc, "rb", closefd=False)
+    reader.seek(offset)
+    os.lseek(fdst, offset, os.SEEK_SET)
+    while offset < size:
+        count = min(blocksize, size - offset)
+        if throttle is not None:
+            throttle(count)
+        n = reader.readinto(view[:count])
+        if not n:
+            break
+        if hasher is not None:
+            hasher.update(view[:n])
+        written = 0
+        while written < n:
+            written += os.write(fdst, view[written:n])
+        offset += n
+    return offset
+
+
+def copyfd(fsrc, fdst, size, blocksize=COPY_BUFSIZE, hasher=None,
+           throttle=None):
+    """Copy the first *size* bytes of the file *fsrc* to the file *fdst*
+
+    Both arguments are file descriptors; *fdst* must be an empty file
+    opened for writing.  Returns the number of bytes copied, which is
+    less than *size* if *fsrc* was truncated in the meantime.  If
+    *hasher* is given, its ``update`` method is called with the data.
+    If *throttle* is given, it is called with the number of bytes
+    before each piece is copied, and may block to limit the rate.
+
+    """
+    if hasher is not None:
+        preallocate(fdst, size)
+        offset = _readinto(fsrc, fdst, 0, size, blocksize, hasher, throttle)
+        if offset < size:
+            os.ftruncate(fdst, offset)
+        return offset
+    chunk = _MAX_CHUNK if throttle is None else blocksize
+    if size > 0 and throttle is None and _reflink(fsrc, fdst):
+        os.ftruncate(fdst, size)
+        return size
+    preallocate(fdst, size)
+    _fadvise(fsrc, "POSIX_FADV_SEQUENTIAL")
+    offset = 0
+    try:
+        for name, method in [("copy_file_range", _copy_file_range),
+                             ("sendfile", _sendfile)]:
+            if offset >= size or not hasattr(os, name):
+                continue
+            try:
+                offset = method(fsrc, fdst, offset, size, chunk, throttle)
+            except OSError as err:
+                if err.errno not in _UNSUPPORTED:
+                    raise
+        if offset < size:
+            offset = _readinto(fsrc, fdst, offset, size, blocksize,
+                               throttle=throttle)
+    finally:
+        # keep the copied data from crowding out the page cache
+        _fadvise(fsrc, "POSIX_FADV_DONTNEED")
+        _fadvise(fdst, "POSIX_FADV_DONTNEED")
+    if offset < size:
+        os.ftruncate(fdst, offset)
+    return offset
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import heapq
+import itertools
+import time
+
+
+POLICIES = ("lru", "lfu", "gdsf")
+
+
+class EvictionPolicy(object):
+    """Decide which cached file to evict next
+
+    *policy* is one of
+
+    ``"lru"``
+        evict the least recently used file
+    ``"lfu"``
+        evict the least frequently used file, ties broken by recency
+    ``"gdsf"``
+        Greedy-Dual-Size-Frequency: evict the file with the lowest
+        ``L + hits / size``, where ``L`` is the priority of the last
+        evicted file; this favours keeping small, popular files
+
+    Priorities are kept in a heap.  Every access pushes a new heap
+    item, and outdated items are skipped when popping, so that adding,
+    accessing and evicting a file cost O(log n).
+
+    """
+
+    def __init__(self, policy="lru"):
+        if policy not in POLICIES:
+            raise ValueError("Unknown eviction policy '{}', use one of "
+                             "{}".format(policy, ", ".join(POLICIES)))
+        self.policy = policy
+        self.nbytes = 0
+        self._sizes = {}
+        self._hits = {}
+        self._keys = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._inflation = 0.
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __contains__(self, path):
+        return path in self._sizes
+
+    def _priority(self, path, accessed):
+        hits = self._hits[path]
+        if self.policy == "lru":
+            return accessed
+        elif self.policy == "lfu":
+            return hits, accessed
+        return self._inflation + hits / max(self._sizes[path], 1)
+
+    def _push(self, path, accessed):
+        key = self._priority(path, accessed)
+        self._keys[path] = key
+        heapq.heappush(self._heap, (key, next(self._counter), path))
+        if len(self._heap) > 2 * len(self._sizes) + 64:
+            self._compact()
+
+    def _compact(self):
+        self._heap = [item for item in self._heap
+                      if self._keys.get(item[2]) == item[0]]
+        heapq.heapify(self._heap)
+
+    def add(self, path, size, accessed=None, hits=1):
+        """Track a newly cached (or replaced) file"""
+        self.remove(path)
+        self._sizes[path] = size
+        self._hits[path] = hits
+        self.nbytes += size
+        self._push(path, time.time() if accessed is None else accessed)
+
+    def access(self, path, accessed=None):
+        """Record a cache hit of *path*"""
+        if path not in self._sizes:
+            return
+        self._hits[path] += 1
+        self._push(path, time.time() if accessed is None else accessed)
+
+    def remove(self, path):
+        """Stop tracking *path*"""
+        if path in self._sizes:
+            self.nbytes -= self._sizes.pop(path)
+            del self._hits[path]
+            del self._keys[path]
+
+    def pop(self, skip=()):
+        """Remove and return the next file to evict
+
+        Files in *skip* are left in place.  Returns None if there is
+        no file that may be evicted.
+
+        """
+        skipped = []
+        victim = None
+        while self._heap:
+            item = heapq.heappop(self._heap)
+            key, _, path = item
+            if self._keys.get(path) != key:
+                continue  # outdated item
+            if path in skip:
+                skipped.append(item)
+                continue
+            victim = path
+            if self.policy == "gdsf":
+                self._inflation = key
+            self.remove(path)
+            break
+        for item in skipped:
+            heapq.heappush(self._heap, item)
+        return victim
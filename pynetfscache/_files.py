@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""Create and replace files in the local storage safely"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import contextlib
+import errno
+import os
+import tempfile
+
+
+def makedirs(dirname):
+    """Create *dirname* and its parents unless they exist"""
+    try:
+        os.makedirs(dirname)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def remove(filename):
+    """Remove *filename* unless it is gone already"""
+    try:
+        os.remove(filename)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+@contextlib.contextmanager
+def publish(filename):
+    """Yield the name of a new file which then atomically replaces *filename*
+
+    The new file is created empty in the directory of *filename*.
+    Once the ``with`` block completes, it is renamed to *filename*, so
+    that readers see either the old or the complete new contents; if
+    the block fails, it is removed.
+
+    """
+    dirname, basename = os.path.split(filename)
+    fd, partpath = tempfile.mkstemp(".part", ".{}.".format(basename),
+                                    dirname)
+    os.close(fd)
+    try:
+        yield partpath
+        os.rename(partpath, filename)
+    except BaseException:
+        remove(partpath)
+        raise
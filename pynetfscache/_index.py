@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import sqlite3
+import threading
+import time
+
+
+INDEX_FILENAME = ".pynetfscache.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    ino INTEGER,
+    checksum TEXT,
+    fetched REAL,
+    accessed REAL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    codec TEXT
+)
+"""
+
+# columns added after the first version, for upgrading older indexes
+_ADDED_COLUMNS = [("codec", "TEXT")]
+
+
+class CacheIndex(object):
+    """A persistent index of cached files, stored in a SQLite database
+
+    Accesses are only recorded in memory and written to the database
+    together with the next change of an entry, after *flush_interval*
+    seconds, or when the index is closed, so that cache hits stay
+    cheap.
+
+    """
+
+    def __init__(self, filename, flush_interval=5.):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # the timeout lets processes sharing the index wait for each other
+        self._conn = sqlite3.connect(filename, timeout=60.,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+        columns = [row[1] for row in
+                   self._conn.execute("PRAGMA table_info(entries)")]
+        for column, declaration in _ADDED_COLUMNS:
+            if column not in columns:
+                self._conn.execute("ALTER TABLE entries ADD COLUMN {} "
+                                   "{}".format(column, declaration))
+        self._conn.commit()
+        self._pending = {}
+        self._last_flush = time.time()
+
+    def load(self):
+        """Return a list of all rows as dicts"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT path, size, mtime, ino, checksum, "
+                "fetched, accessed, hits, codec FROM entries")
+            keys = [d[0] for d in cursor.description]
+            return [dict(zip(keys, row)) for row in cursor]
+
+    def put(self, path, size, mtime, ino, fetched, checksum=None,
+            codec=None):
+        """Insert or replace the entry for *path*"""
+        with self._lock:
+            self._pending.pop(path, None)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (path, size, mtime, ino, "
+                "checksum, fetched, accessed, hits, codec) VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                (path, size, mtime, ino, checksum, fetched, fetched, codec))
+            self._flush()
+
+    def touch(self, path, accessed=None):
+        """Record an access (cache hit) of *path*"""
+        if accessed is None:
+            accessed = time.time()
+        with self._lock:
+            hits = self._pending.get(path, (None, 0))[1]
+            self._pending[path] = accessed, hits + 1
+            if accessed - self._last_flush > self.flush_interval:
+                self._flush()
+
+    def remove(self, path):
+        """Remove the entry for *path*"""
+        with self._lock:
+            self._pending.pop(path, None)
+            self._conn.execute("DELETE FROM entries WHERE path = ?", (path,))
+            self._flush()
+
+    def flush(self):
+        """Write all recorded accesses to the database"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._conn.executemany(
+                "UPDATE entries SET accessed = ?, hits = hits + ? "
+                "WHERE path = ?",
+                [(accessed, hits, path)
+                 for path, (accessed, hits) in self._pending.items()])
+            self._pending = {}
+        self._conn.commit()
+        self._last_flush = time.time()
+
+    def close(self):
+        """Flush pending accesses and close the database"""
+        with self._lock:
+            if self._conn is None:
+                return
+            self._flush()
+            self._conn.close()
+            self._conn = None
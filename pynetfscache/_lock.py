@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import errno
+import os
+
+try:
+    import fcntl
+    _FCNTL = True
+except ImportError:
+    _FCNTL = False
+
+
+class FileLock(object):
+    """An advisory lock on the file *filename*, using ``flock``
+
+    The lock is exclusive unless *shared* is true.  Locks taken
+    through different FileLock objects exclude each other, within one
+    process as well as across processes.  The lock file is created if
+    need be, and never removed.
+
+    """
+
+    def __init__(self, filename, shared=False):
+        if not _FCNTL:
+            raise ImportError("Cannot import fcntl, which is needed for "
+                              "file locks")
+        self.filename = filename
+        self.shared = shared
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """Acquire the lock, or return False if not *blocking* and taken"""
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except (IOError, OSError) as err:
+            os.close(fd)
+            if not blocking and err.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import collections
+import threading
+
+from ._eviction import EvictionPolicy
+
+
+class MemoryTier(object):
+    """An in-memory tier holding the contents of frequently read files
+
+    A file is promoted into memory once it was read *promote_hits*
+    times.  When the contents in memory exceed *max_bytes*, the least
+    frequently read files are demoted, i.e. dropped from memory; the
+    disk tier still holds them.  Contents are only served for the
+    cache entry they were read from, so that a file which was fetched
+    again is read from disk again.
+
+    """
+
+    def __init__(self, max_bytes, promote_hits=2):
+        self.max_bytes = max_bytes
+        self.promote_hits = promote_hits
+        self._lock = threading.Lock()
+        self._data = {}
+        self._reads = collections.Counter()
+        self._policy = EvictionPolicy("lfu")
+
+    @property
+    def nbytes(self):
+        return self._policy.nbytes
+
+    def __contains__(self, path):
+        return path in self._data
+
+    def get(self, path, entry):
+        """Record a read of *path* and return its contents, or None"""
+        with self._lock:
+            self._reads[path] += 1
+            item = self._data.get(path)
+            if item is None:
+                return None
+            if item[0] is not entry:
+                self._drop(path)
+                return None
+            self._policy.access(path)
+            return item[1]
+
+    def put(self, path, entry, data):
+        """Offer the contents *data* of *path*, read from *entry*
+
+        They are kept if *path* was read often enough, demoting less
+        frequently read files if need be.  Returns whether *data* was
+        promoted.
+
+        """
+        with self._lock:
+            reads = self._reads[path]
+            if reads < self.promote_hits or len(data) > self.max_bytes:
+                return False
+            self._drop(path)
+            self._data[path] = entry, data
+            self._policy.add(path, len(data), hits=reads)
+            while self._policy.nbytes > self.max_bytes:
+                self._drop(self._policy.pop())
+            return path in self._data
+
+    def discard(self, path):
+        """Forget *path*, e.g. because it left the disk tier"""
+        with self._lock:
+            self._drop(path)
+            self._reads.pop(path, None)
+
+    def _drop(self, path):
+        if self._data.pop(path, None) is not None:
+            self._policy.remove(path)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+import threading
+import time
+
+
+def normpath(path):
+    """Normalize the relative *path*; the root is ``"."``"""
+    return os.path.normpath(path) if path else "."
+
+
+class _Listing(object):
+
+    __slots__ = ["mtime", "modes", "checked"]
+
+    def __init__(self, mtime, modes, checked):
+        self.mtime = mtime
+        self.modes = modes
+        self.checked = checked
+
+
+class MetadataCache(object):
+    """Cache directory listings and file types of the remote storage
+
+    Listings are fetched in bulk with *scandir*, which is called with
+    a relative directory path and returns the mtime of the directory
+    and a dict mapping the names of its entries to their ``st_mode``
+    (or None if the mode is unknown, in which case it is looked up
+    with *stat* on demand).
+
+    A listing is served without any I/O for *ttl* seconds.  After
+    that, the directory is stat'ed once, and only listed again if its
+    mtime changed.  Paths which could not be listed are remembered
+    as missing for *ttl* seconds, too.
+
+    """
+
+    def __init__(self, scandir, stat, ttl=5.):
+        self._scandir = scandir
+        self._stat = stat
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._missing = {}
+
+    def listdir(self, path):
+        """Return the dict of entry names and modes of directory *path*"""
+        path = normpath(path)
+        now = time.time()
+        with self._lock:
+            listing = self._listings.get(path)
+            missing = self._missing.get(path)
+        if missing is not None and now - missing[1] < self.ttl:
+            raise missing[0]
+        if listing is not None:
+            if now - listing.checked < self.ttl:
+                return listing.modes
+            try:
+                mtime = self._stat(path).st_mtime
+            except (IOError, OSError) as err:
+                self._forget(path, err, now)
+                raise
+            if mtime == listing.mtime:
+                listing.checked = now
+                return listing.modes
+        try:
+            mtime, modes = self._scandir(path)
+        except (IOError, OSError) as err:
+            self._forget(path, err, now)
+            raise
+        with self._lock:
+            self._listings[path] = _Listing(mtime, modes, now)
+            self._missing.pop(path, None)
+        return modes
+
+    def _forget(self, path, err, now):
+        with self._lock:
+            self._listings.pop(path, None)
+            self._missing[path] = err, now
+
+    def mode(self, path):
+        """Return the ``st_mode`` of *path*, or None if it is missing"""
+        path = normpath(path)
+        if path == ".":
+            return self._stat(path).st_mode
+        dirname, name = os.path.split(path)
+        try:
+            modes = self.listdir(dirname)
+        except (IOError, OSError):
+            return None
+        if name not in modes:
+            return None
+        if modes[name] is None:
+            try:
+                modes[name] = self._stat(path).st_mode
+            except (IOError, OSError):
+                return None
+        return modes[name]
+
+    def invalidate(self, path=None):
+        """Forget the listing of directory *path*, or of all directories"""
+        with self._lock:
+            if path is None:
+                self._listings.clear()
+                self._missing.clear()
+            else:
+                self._listings.pop(normpath(path), None)
+                self._missing.pop(normpath(path), None)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import bisect
+import collections
+import threading
+
+
+COUNTERS = ("hits", "misses", "coalesced", "bytes_served", "bytes_fetched",
+            "fetch_errors", "evictions", "memory_hits")
+
+HISTOGRAMS = ("fetch_seconds", "clean_seconds")
+
+# upper bounds of the histogram buckets, in seconds; the last bucket
+# is unbounded
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.,
+           30., 60., 300.)
+
+
+class MetricsHook(object):
+    """Base class for receivers of the metrics of a cache
+
+    Hooks are added with :meth:`Metrics.add_hook` and called in the
+    thread where the event happens, so they should be quick (e.g.
+    send a UDP packet to StatsD, or update a Prometheus metric).
+
+    """
+
+    def count(self, name, value):
+        """Called when the counter *name* is increased by *value*"""
+
+    def observe(self, name, value):
+        """Called when *value* is recorded in the histogram *name*"""
+
+
+class _Shard(object):
+    """The metrics recorded by one thread"""
+
+    def __init__(self):
+        # all keys exist from the start, so that the dicts never change
+        # size while another thread sums them up
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.buckets = dict((name, [0] * (len(BUCKETS) + 1))
+                            for name in HISTOGRAMS)
+        self.sums = dict.fromkeys(HISTOGRAMS, 0.)
+
+
+class Metrics(object):
+    """Counters and histograms of the events of a cache
+
+    Every thread records into its own shard, so that recording takes
+    no lock; :meth:`snapshot` adds up the shards.  The counters and
+    histograms are listed in :data:`COUNTERS` and :data:`HISTOGRAMS`.
+
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """Pass all future events to *hook* (see :class:`MetricsHook`)"""
+        with self._lock:
+            self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self.hooks = [h for h in self.hooks if h is not hook]
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def count(self, name, value=1):
+        self._shard().counters[name] += value
+        for hook in self.hooks:
+            hook.count(name, value)
+
+    def observe(self, name, value):
+        shard = self._shard()
+        shard.buckets[name][bisect.bisect_left(BUCKETS, value)] += 1
+        shard.sums[name] += value
+        for hook in self.hooks:
+            hook.observe(name, value)
+
+    def snapshot(self):
+        """Return the current totals as a dict
+
+        Counters map to their values; histograms map to a dict with
+        the ``count`` and ``sum`` of the recorded values, ``buckets``
+        mapping the upper bound of each bucket to the number of values
+        up to it (the last bound is ``inf``), and the estimated ``p50``
+        and ``p99``: the upper bounds of the buckets holding these
+        percentiles.
+
+        """
+        with self._lock:
+            shards = list(self._shards)
+        snapshot = dict.fromkeys(COUNTERS, 0)
+        for shard in shards:
+            for name, value in list(shard.counters.items()):
+                snapshot[name] += value
+        bounds = BUCKETS + (float("inf"),)
+        for name in HISTOGRAMS:
+            counts = [0] * len(bounds)
+            total = 0.
+            for shard in shards:
+                for i, n in enumerate(list(shard.buckets[name])):
+                    counts[i] += n
+                total += shard.sums[name]
+            cumulative = []
+            for n in counts:
+                cumulative.append(n + (cumulative[-1] if cumulative else 0))
+            histogram = {"count": cumulative[-1], "sum": total,
+                         "buckets": collections.OrderedDict(
+                             zip(bounds, cumulative))}
+            for key, quantile in [("p50", .5), ("p99", .99)]:
+                histogram[key] = None
+                if cumulative[-1]:
+                    i = bisect.bisect_left(cumulative,
+                                           quantile * cumulative[-1])
+                    histogram[key] = bounds[i]
+            snapshot[name] = histogram
+        return snapshot
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import collections
+import contextlib
+import os
+import re
+import threading
+
+
+# the last number in a filename, and what follows it
+_NUMBER = re.compile(r"(\d+)(\D*)$")
+
+
+class Prefetcher(object):
+    """Retrieve queued paths in the background
+
+    Up to *workers* daemon threads, started on demand, call *retrieve*
+    for every queued path.  They only start a new retrieval while no
+    foreground retrieval (see :meth:`foreground`) is running, so that
+    prefetching does not compete with requests someone waits for.
+    Errors are ignored; they surface when the path is retrieved in the
+    foreground.
+
+    """
+
+    def __init__(self, retrieve, workers=2):
+        self._retrieve = retrieve
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._queued = set()
+        self._foreground = 0
+        self._active = 0
+        self._threads = []
+        self._stopped = False
+
+    def put(self, paths):
+        """Queue *paths* for retrieval"""
+        with self._cond:
+            if self._stopped or self.workers < 1:
+                return
+            for path in paths:
+                if path not in self._queued:
+                    self._queue.append(path)
+                    self._queued.add(path)
+            while self._queue and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._queue or
+                                             self._foreground):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                path = self._queue.popleft()
+                self._queued.discard(path)
+                self._active += 1
+            try:
+                self._retrieve(path)
+            except Exception:
+                pass
+            finally:
+                with self._cond:
+                    self._active -= 1
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def foreground(self):
+        """Pause prefetching while the ``with`` block runs"""
+        with self._cond:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._foreground -= 1
+                self._cond.notify_all()
+
+    def wait(self):
+        """Wait until the queue is empty and all prefetches are done"""
+        with self._cond:
+            while not self._stopped and (self._queue or self._active):
+                self._cond.wait()
+
+    def stop(self):
+        """Drop the queue and stop the threads after their current work"""
+        with self._cond:
+            self._stopped = True
+            self._queue.clear()
+            self._queued.clear()
+            self._cond.notify_all()
+
+
+class SequencePredictor(object):
+    """Predict the next files of numbered sequences
+
+    Filenames are grouped by their directory and the text around
+    their last number.  Once two files of a group are observed, the
+    next *depth* files continuing the step between them are
+    predicted: after ``day_001.nc`` and ``day_002.nc``, for instance,
+    ``day_003.nc`` and ``day_004.nc`` for a depth of 2.
+
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self._lock = threading.Lock()
+        self._last = {}
+
+    def observe(self, path):
+        """Record an access to *path* and return the predicted paths"""
+        dirname, basename = os.path.split(path)
+        match = _NUMBER.search(basename)
+        if match is None:
+            return []
+        digits = match.group(1)
+        prefix, suffix = basename[:match.start(1)], match.group(2)
+        number = int(digits)
+        with self._lock:
+            last = self._last.get((dirname, prefix, suffix))
+            self._last[(dirname, prefix, suffix)] = number
+        if last is None or last == number:
+            return []
+        step = number - last
+        width = len(digits) if digits.startswith("0") else 1
+        predicted = []
+        for i in range(1, self.depth + 1):
+            following = number + i * step
+            if following < 0:
+                break
+            predicted.append(os.path.join(dirname, "{}{}{}".format(
+                prefix, str(following).zfill(width), suffix)))
+        return predicted
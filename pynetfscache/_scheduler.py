@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import collections
+import contextlib
+import threading
+import timeit
+
+
+# the priority classes of transfers, most urgent first
+PRIORITIES = ("foreground", "sync", "prefetch")
+
+
+class _Ticket(object):
+
+    __slots__ = ("host", "priority", "caller")
+
+    def __init__(self, host, priority, caller):
+        if priority not in PRIORITIES:
+            raise ValueError("Unknown priority '{}', use one of {}".format(
+                priority, ", ".join(PRIORITIES)))
+        self.host = host
+        self.priority = PRIORITIES.index(priority)
+        self.caller = caller
+
+
+class _FairQueue(object):
+    """Waiting tickets, served by priority and round-robin over callers"""
+
+    def __init__(self):
+        self._callers = [collections.OrderedDict() for _ in PRIORITIES]
+
+    def push(self, ticket):
+        callers = self._callers[ticket.priority]
+        callers.setdefault(ticket.caller, collections.deque()).append(ticket)
+
+    def heads(self):
+        """Iterate over the first ticket of every caller in serving order"""
+        for callers in self._callers:
+            for queue in list(callers.values()):
+                yield queue[0]
+
+    def remove(self, ticket, served=False):
+        """Remove *ticket*; if it was *served*, its caller goes last"""
+        callers = self._callers[ticket.priority]
+        queue = callers[ticket.caller]
+        queue.remove(ticket)
+        if served or not queue:
+            del callers[ticket.caller]
+            if queue:
+                callers[ticket.caller] = queue
+
+
+class TransferScheduler(object):
+    """Admit transfers within limits on bandwidth and concurrency
+
+    At most *max_transfers* transfers from the same host run at once;
+    *host_limits* maps host names to other limits.  The data of all
+    transfers passes a token bucket refilled with *bandwidth* bytes
+    per second, which holds up to *burst* bytes (by default, one
+    second's worth).  None means no limit.  The limits can be changed
+    at runtime with :meth:`set_bandwidth` and :meth:`set_max_transfers`.
+
+    Waiting transfers are served by their priority class (see
+    :data:`PRIORITIES`): foreground retrievals before :meth:`sync`,
+    and these before prefetches.  Within a class, the callers, i.e.
+    the threads which started the transfers, take turns, so that a
+    large batch does not starve a single request.  A transfer only
+    waits for others from the same host, so that a busy host does not
+    hold up the others.
+
+    A scheduler can be shared by several caches, so that the limits
+    apply to all of them together.
+
+    """
+
+    def __init__(self, bandwidth=None, max_transfers=None, host_limits=None,
+                 burst=None):
+        self._cond = threading.Condition()
+        self._bandwidth = None
+        self.set_bandwidth(bandwidth, burst)
+        self.max_transfers = max_transfers
+        self.host_limits = dict(host_limits or {})
+        self._active = collections.Counter()
+        self._slots = _FairQueue()
+        self._consumers = _FairQueue()
+
+    @property
+    def bandwidth(self):
+        return self._bandwidth
+
+    def set_bandwidth(self, bandwidth, burst=None):
+        """Limit the bandwidth to *bandwidth* bytes per second"""
+        with self._cond:
+            self._bandwidth = bandwidth
+            self.burst = burst if burst is not None else bandwidth
+            self._tokens = self.burst
+            self._stamp = timeit.default_timer()
+            self._cond.notify_all()
+
+    def set_max_transfers(self, limit, host=None):
+        """Limit the concurrent transfers from *host*, or all hosts"""
+        with self._cond:
+            if host is None:
+                self.max_transfers = limit
+            elif limit is None:
+                self.host_limits.pop(host, None)
+            else:
+                self.host_limits[host] = limit
+            self._cond.notify_all()
+
+    def _has_slot(self, host):
+        limit = self.host_limits.get(host, self.max_transfers)
+        return limit is None or self._active[host] < limit
+
+    def _next_slot(self):
+        for ticket in self._slots.heads():
+            if self._has_slot(ticket.host):
+                return ticket
+
+    @contextlib.contextmanager
+    def slot(self, host, priority="foreground", caller=None):
+        """Run the ``with`` block as a transfer from *host*
+
+        *caller* identifies who the transfer is for; it defaults to the
+        current thread.
+
+        """
+        if caller is None:
+            caller = threading.current_thread().ident
+        ticket = _Ticket(host, priority, caller)
+        with self._cond:
+            self._slots.push(ticket)
+            try:
+                while self._next_slot() is not ticket:
+                    self._cond.wait()
+            except BaseException:
+                self._slots.remove(ticket)
+                self._cond.notify_all()
+                raise
+            self._slots.remove(ticket, served=True)
+            self._active[host] += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active[host] -= 1
+                self._cond.notify_all()
+
+    def _refill(self):
+        now = timeit.default_timer()
+        self._tokens = min(self.burst, self._tokens +
+                           (now - self._stamp) * self._bandwidth)
+        self._stamp = now
+
+    def consume(self, nbytes, priority="foreground", caller=None):
+        """Wait until *nbytes* may be transferred
+
+        The bucket may go into debt for large requests, which then
+        delays the following ones, so that the average rate holds
+        whatever the size of the requests.
+
+        """
+        if self._bandwidth is None:
+            return
+        if caller is None:
+            caller = threading.current_thread().ident
+        ticket = _Ticket(None, priority, caller)
+        with self._cond:
+            self._consumers.push(ticket)
+            try:
+                while True:
+                    if self._bandwidth is None:
+                        break
+                    self._refill()
+                    first = next(self._consumers.heads())
+                    if first is ticket and self._tokens > 0:
+                        self._tokens -= nbytes
+                        break
+                    if first is ticket:
+                        self._cond.wait(max(-self._tokens / self._bandwidth,
+                                            .001))
+                    else:
+                        self._cond.wait()
+            finally:
+                self._consumers.remove(ticket, served=True)
+                self._cond.notify_all()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import, division, unicode_literals
+
+import errno
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from ._copy import pwrite
+from ._files import makedirs
+
+
+SPARSE_DIRNAME = ".pynetfscache.sparse"
+
+# the suffix which SparseState appends to the name of a sparse file
+_SPARSENAME = re.compile(r"\.\w+\.sparse$")
+
+
+def iter_sparse_files(root):
+    """Yield (relpath, filename) for the sparse files below *root*
+
+    *relpath* is the relative path of the file whose blocks the
+    sparse file *filename* holds.
+
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            match = _SPARSENAME.search(name)
+            if match is None or match.start() == 0:
+                continue
+            filename = os.path.join(dirpath, name)
+            relpath = os.path.relpath(filename, root)
+            yield relpath[:len(relpath) - len(match.group())], filename
+
+
+def remove_unused(filename):
+    """Remove the sparse file *filename* unless a SparseState uses it
+
+    Returns whether the file was removed.  Without ``flock``, the use
+    by other processes cannot be detected.
+
+    """
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return False
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as err:
+                if err.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+        os.remove(filename)
+    finally:
+        os.close(fd)
+    return True
+
+
+class SparseState(object):
+    """The blocks of one source file present in a sparse local file
+
+    A new file named after *filename*, in its directory, is created
+    with the size of the source file, as given by its stat result
+    *st*, without allocating any blocks; its name is unique, so that
+    other caches on the same directory never write to it.  Which of
+    its blocks of *blocksize* bytes hold data is tracked in
+    :attr:`bitmap`.  The file is kept open, so that it can be filled
+    even after it was renamed or removed, and locked with a shared
+    ``flock``, so that :func:`remove_unused` leaves it alone.
+
+    """
+
+    def __init__(self, filename, st, blocksize):
+        self.st = st
+        self.size = st.st_size
+        self.blocksize = blocksize
+        self.nblocks = (self.size + blocksize - 1) // blocksize
+        self.bitmap = bytearray((self.nblocks + 7) // 8)
+        self.missing = self.nblocks
+        self.lock = threading.Lock()
+        self.time = time.time()
+        makedirs(os.path.dirname(filename))
+        self._fd, self.filename = tempfile.mkstemp(
+            ".sparse", os.path.basename(filename) + ".",
+            os.path.dirname(filename))
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+        os.ftruncate(self._fd, self.size)
+
+    def __del__(self):
+        if getattr(self, "_fd", None) is not None:
+            os.close(self._fd)
+
+    def has(self, block):
+        return bool(self.bitmap[block >> 3] & (1 << (block & 7)))
+
+    def _mark(self, block):
+        if not self.has(block):
+            self.bitmap[block >> 3] |= 1 << (block & 7)
+            self.missing -= 1
+
+    def fill(self, start, stop, read_range):
+        """Make sure that the blocks *start* to *stop* - 1 are present
+
+        Runs of missing blocks are fetched with one call each of
+        ``read_range(offset, length, write)``, which passes the data
+        to ``write(position, data)``.  Returns whether this completed
+        the file.
+
+        """
+        stop = min(stop, self.nblocks)
+        with self.lock:
+            if not self.missing:
+                return False
+            runs = []
+            for block in range(start, stop):
+                if self.has(block):
+                    continue
+                if runs and runs[-1][1] == block:
+                    runs[-1][1] = block + 1
+                else:
+                    runs.append([block, block + 1])
+            for first, last in runs:
+                offset = first * self.blocksize
+                length = min(last * self.blocksize, self.size) - offset
+                # the end of the data written so far; pieces may be
+                # written twice if the backend retries a request
+                end = [offset]
+
+                def _write(pos, data):
+                    pwrite(self._fd, data, pos)
+                    end[0] = max(end[0], pos + len(data))
+                read_range(offset, length, _write)
+                if end[0] != offset + length:
+                    raise IOError(errno.EIO, "Remote file changed or was "
+                                  "truncated during the transfer",
+                                  self.filename)
+                for block in range(first, last):
+                    self._mark(block)
+            return not self.missing
+
+
+class SparseFile(io.RawIOBase):
+    """A seekable, read-only file filled lazily from remote storage
+
+    Reads are served from the sparse local file of *state*; blocks
+    which are missing there are fetched with *read_range* (see
+    :meth:`SparseState.fill`) first, together with *readahead*
+    following blocks.  *on_complete* is called once all blocks of
+    the file are present.
+
+    """
+
+    def __init__(self, state, read_range, readahead=1, on_complete=None):
+        super(SparseFile, self).__init__()
+        self._state = state
+        self._read_range = read_range
+        self.readahead = readahead
+        self._on_complete = on_complete
+        self._file = io.open(state.filename, "rb", buffering=0)
+        self._pos = 0
+        self.name = state.filename
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._state.size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        state = self._state
+        n = max(0, min(len(b), state.size - self._pos))
+        if not n:
+            return 0
+        first = self._pos // state.blocksize
+        last = (self._pos + n - 1) // state.blocksize
+        if state.fill(first, last + 1 + self.readahead,
+                      self._read_range) and self._on_complete is not None:
+            self._on_complete(state)
+        self._file.seek(self._pos)
+        view = memoryview(b)[:n]
+        got = 0
+        while got < n:
+            count = self._file.readinto(view[got:])
+            if not count:
+                break
+            got += count
+        self._pos += got
+        return got
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super(SparseFile, self).close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+"""An asyncio front end for the filesystem caches
+
+This module requires Python 3.6 or newer and is therefore not
+imported by :mod:`pynetfscache` itself.
+
+"""
+
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from ._base import _MAGIC, RetrieveError
+
+try:
+    _get_running_loop = asyncio.get_running_loop
+except AttributeError:  # Python 3.6
+    _get_running_loop = asyncio.get_event_loop
+
+
+class AsyncFilesystemCache(object):
+    """An asyncio front end for a :class:`FilesystemCache`
+
+    ::
+
+        cache = AsyncFilesystemCache(LocalFilesystemCache("/mnt/nfs"))
+        filename = await cache.retrieve("data.nc")
+        async for filename in cache.retrieve_iter(paths):
+            process(filename)
+
+    The backends are blocking, so the transfers of *cache* run on a
+    private pool of *concurrency* threads (default: ``cache.workers``)
+    and at most *concurrency* retrievals are in flight.  The others
+    wait on a semaphore; if they are cancelled while waiting, they
+    never start.  A transfer which already started cannot be
+    interrupted and completes in the background, so its file is cached
+    even if its caller was cancelled.
+
+    """
+
+    def __init__(self, cache, concurrency=None):
+        self.cache = cache
+        self.concurrency = concurrency or cache.workers
+        self._executor = ThreadPoolExecutor(self.concurrency)
+        # created on first use, so that it belongs to the running loop
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def close(self):
+        """Shut down the thread pool without waiting for transfers"""
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args):
+        loop = _get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _retrieve_blocking(self, path, observe):
+        # like FilesystemCache.retrieve, prefetches pause while the
+        # file is retrieved, and single paths feed the predictor
+        cache = self.cache
+        with cache._prefetcher.foreground():
+            filename = cache._retrieve_single(path)
+        if observe and cache._predictor is not None:
+            cache._prefetcher.put(cache._predictor.observe(path))
+        return filename
+
+    async def _retrieve_single(self, path, observe=False):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            return await self._run(self._retrieve_blocking, path, observe)
+
+    async def _expand(self, path):
+        if isinstance(path, str):
+            return await self._run(self.cache._expand, path)
+        return list(path)
+
+    async def retrieve(self, path):
+        """Retrieve files from remote storage
+
+        This is the awaitable version of
+        :meth:`FilesystemCache.retrieve`: *path* can be a relative
+        path, a glob pattern or an iterable of paths, and failures in
+        a batch are raised together as a :class:`RetrieveError`.
+
+        """
+        if isinstance(path, str) and not _MAGIC.search(path):
+            return await self._retrieve_single(path, observe=True)
+        paths = await self._expand(path)
+        results = await asyncio.gather(
+            *[self._retrieve_single(p) for p in paths],
+            return_exceptions=True)
+        errors = collections.OrderedDict(
+            (p, result) for p, result in zip(paths, results)
+            if isinstance(result, Exception))
+        if errors:
+            raise RetrieveError(
+                errors, [None if isinstance(result, Exception) else result
+                         for result in results])
+        return results
+
+    async def retrieve_iter(self, paths):
+        """Retrieve *paths* and yield the local filenames as they arrive
+
+        *paths* is an iterable of relative paths or a glob pattern.
+        The filenames are yielded in the order in which the transfers
+        complete.  If a transfer fails, its exception is raised from
+        the iterator; leaving the iterator early cancels the pending
+        transfers.
+
+        """
+        tasks = [asyncio.ensure_future(self._retrieve_single(p))
+                 for p in await self._expand(paths)]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
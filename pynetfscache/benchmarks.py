@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks of the caches against emulated network filesystems
+
+Run them with::
+
+    python -m pynetfscache.benchmarks --latency 20 --bandwidth 50
+
+The remote filesystem is a local directory, served either directly
+to a :class:`LocalFilesystemCache` (standing in for NFS) or by the
+``sftpserver`` package to an :class:`SFTPFilesystemCache`.  Every
+request to it is delayed by the round-trip *latency*, and the
+transfers of each cache share a link of *bandwidth* MiB/s, which is
+emulated with a :class:`TransferScheduler`.
+
+The workloads are:
+
+``small_files``
+    many small files retrieved cold (misses), then again (hits), by
+    several threads at once;
+``huge_files``
+    a few huge files retrieved one after the other;
+``hit_miss``
+    a shuffled pass over the small files when a share of *hit_ratio*
+    of them is cached already;
+``clean``
+    :meth:`clean` on a pattern and then on all of a large number of
+    cached entries; this is independent of the backend and only run
+    with the local one;
+``concurrent``
+    several readers reading the same medium-sized files with
+    :meth:`read` in different orders.
+
+For each, the throughput, the rate of operations, the median and
+99th percentile of the latency of the operations, and the CPU time of
+this process per GiB transferred or served are reported.  The data
+and the orders of the files depend only on *seed*, so that results
+are comparable between runs; ``--json`` writes them for tracking.
+
+"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import argparse
+import collections
+import getpass
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from multiprocessing.pool import ThreadPool
+
+from .local import LocalFilesystemCache
+from ._scheduler import TransferScheduler
+
+
+WORKLOADS = ("small_files", "huge_files", "hit_miss", "clean", "concurrent")
+
+BACKENDS = ("local", "sftp")
+
+Result = collections.namedtuple("Result", ["workload", "backend", "ops",
+                                           "nbytes", "seconds", "cpu",
+                                           "latencies"])
+
+_KEYFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests",
+                        "id_rsa")
+# the directory containing the package, for the server subprocess
+_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve_sftp(port, keyfile, host="localhost"):
+    """Serve the current directory by SFTP on *port*, forever
+
+    This uses the stub server of sftpserver, with the host key in
+    *keyfile*, but unlike ``sftpserver.start_server``, it serves
+    several connections at once and survives connections which fail
+    the handshake.
+
+    """
+    import paramiko
+    from sftpserver.stub_sftp import StubServer, StubSFTPServer
+    hostkey = paramiko.RSAKey.from_private_key_file(keyfile)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(16)
+    while True:
+        conn = server.accept()[0]
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(hostkey)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer,
+                                        StubSFTPServer)
+        try:
+            # the transport serves the connection in its own thread
+            transport.start_server(server=StubServer())
+        except (EOFError, paramiko.SSHException):
+            transport.close()
+
+
+class _EmulatedLink(object):
+    """Mixin delaying every request of a backend by :attr:`latency`"""
+
+    latency = 0.
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _retrieve(self, path, hasher=None):
+        self._delay()
+        return super(_EmulatedLink, self)._retrieve(path, hasher)
+
+    def _stat(self, path):
+        self._delay()
+        return super(_EmulatedLink, self)._stat(path)
+
+    def _read_range(self, sourcepath, offset, length, write):
+        self._delay()
+        return super(_EmulatedLink, self)._read_range(sourcepath, offset,
+                                                      length, write)
+
+    def _listdir_stat(self, dirname):
+        self._delay()
+        return super(_EmulatedLink, self)._listdir_stat(dirname)
+
+    def _scandir(self, dirname):
+        self._delay()
+        return super(_EmulatedLink, self)._scandir(dirname)
+
+
+def _emulated(backend):
+    return type(str("Emulated" + backend.__name__), (_EmulatedLink, backend),
+                {})
+
+
+def _cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def percentile(values, q):
+    """Return the *q*-quantile of *values*, by the nearest rank"""
+    if not values:
+        return None
+    return sorted(values)[max(0, int(math.ceil(q * len(values))) - 1)]
+
+
+def measure(func, items, threads=1):
+    """Call *func* on all *items* with *threads* threads
+
+    Returns the wall time, the CPU time and the latencies of the
+    calls.
+
+    """
+    def _timed(item):
+        start = timeit.default_timer()
+        func(item)
+        return timeit.default_timer() - start
+    cpu = _cpu_time()
+    start = timeit.default_timer()
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            latencies = pool.map(_timed, items)
+        finally:
+            pool.close()
+    else:
+        latencies = [_timed(item) for item in items]
+    return timeit.default_timer() - start, _cpu_time() - cpu, latencies
+
+
+def _write_files(remote, dirname, count, size, rng):
+    """Create *count* files of *size* bytes below *remote*
+
+    Returns their paths relative to *remote*.
+
+    """
+    os.makedirs(os.path.join(remote, dirname))
+    block = bytes(bytearray(rng.getrandbits(8) for _ in range(2**16)))
+    paths = [os.path.join(dirname, "f{:06d}".format(i)) for i in range(count)]
+    for path in paths:
+        with open(os.path.join(remote, path), "wb") as fd:
+            for offset in range(0, size, len(block)):
+                fd.write(block[:size - offset])
+    return paths
+
+
+class _Bench(object):
+    """The remote directory and the settings shared by the workloads"""
+
+    def __init__(self, args, remote):
+        self.args = args
+        self.remote = remote
+        self.rng = random.Random(args.seed)
+        self._server = None
+        self._files = {}
+
+    def files(self, name, count, size):
+        """Return the paths of *count* remote files of *size* bytes"""
+        if name not in self._files:
+            self._files[name] = _write_files(self.remote, name, count, size,
+                                             self.rng)
+        return self._files[name]
+
+    def cache(self, backend, **kwargs):
+        scheduler = None
+        if self.args.bandwidth:
+            scheduler = TransferScheduler(
+                bandwidth=self.args.bandwidth * 2**20,
+                burst=self.args.bandwidth * 2**20 / 10)
+        kwargs.setdefault("workers", self.args.threads)
+        if backend == "local":
+            cache = _emulated(LocalFilesystemCache)(
+                self.remote, scheduler=scheduler, **kwargs)
+        else:
+            from .sftp import SFTPFilesystemCache
+            self._start_server()
+            # the key of the throwaway server is accepted as unknown;
+            # id_rsa.pub is no known_hosts file
+            cache = _emulated(SFTPFilesystemCache)(
+                ".", "localhost", getpass.getuser(), port=self.args.port,
+                password="test", ssh_unknown_hosts=True,
+                scheduler=scheduler, **kwargs)
+        cache.latency = self.args.latency / 1000.
+        return cache
+
+    def _start_server(self):
+        """Serve the remote directory with :func:`serve_sftp`
+
+        The server is a separate process, so that its CPU time is not
+        counted.
+
+        """
+        if self._server is not None:
+            return
+        self._server = subprocess.Popen(
+            [sys.executable, "-c", "import sys; sys.path.insert(0, "
+             "sys.argv[3]); from pynetfscache.benchmarks import "
+             "serve_sftp; serve_sftp(int(sys.argv[1]), sys.argv[2])",
+             str(self.args.port), _KEYFILE, _PARENT], cwd=self.remote)
+        # the server is ready once it completes an SSH handshake
+        import paramiko
+        deadline = time.time() + 10
+        while True:
+            try:
+                sock = socket.create_connection(("localhost",
+                                                 self.args.port), 1)
+                transport = paramiko.Transport(sock)
+                try:
+                    transport.start_client(timeout=1)
+                finally:
+                    transport.close()
+                    sock.close()
+                return
+            except (socket.error, EOFError, paramiko.SSHException):
+                if self._server.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("Cannot start sftpserver")
+                time.sleep(.1)
+
+    def close(self):
+        if self._server is not None:
+            if self._server.poll() is None:
+                self._server.terminate()
+            self._server.wait()
+
+
+def bench_small_files(bench, backend):
+    args = bench.args
+    paths = bench.files("small", args.small_files, args.small_size)
+    cache = bench.cache(backend)
+    results = []
+    for workload in ["small_files/miss", "small_files/hit"]:
+        seconds, cpu, latencies = measure(cache.retrieve, paths,
+                                          args.threads)
+        results.append(Result(workload, backend, len(paths),
+                              len(paths) * args.small_size, seconds,
+                              cpu, latencies))
+    return results
+
+
+def bench_huge_files(bench, backend):
+    args = bench.args
+    size = args.huge_size * 2**20
+    paths = bench.files("huge", args.huge_files, size)
+    cache = bench.cache(backend)
+    seconds, cpu, latencies = measure(cache.retrieve, paths)
+    return [Result("huge_files/miss", backend, len(paths),
+                   len(paths) * size, seconds, cpu, latencies)]
+
+
+def bench_hit_miss(bench, backend):
+    args = bench.args
+    paths = bench.files("small", args.small_files, args.small_size)
+    order = list(paths)
+    bench.rng.shuffle(order)
+    cache = bench.cache(backend)
+    cache.retrieve(order[:int(args.hit_ratio * len(order))])
+    bench.rng.shuffle(order)
+    seconds, cpu, latencies = measure(cache.retrieve, order)
+    return [Result("hit_miss/{:g}".format(args.hit_ratio), backend,
+                   len(order), len(order) * args.small_size, seconds,
+                   cpu, latencies)]
+
+
+def bench_clean(bench, backend):
+    if backend != "local":
+        return []
+    args = bench.args
+    paths = bench.files("clean", args.clean_entries, 0)
+    cache = bench.cache(backend, workers=8)
+    # populate without the emulated link, which is not measured
+    cache.latency, latency = 0., cache.latency
+    cache.scheduler = None
+    cache.retrieve(paths)
+    cache.latency = latency
+    results = []
+    for workload, pattern in [("clean/pattern", "clean/f0000*"),
+                              ("clean/all", None)]:
+        entries = cache.stats()["files"]
+        seconds, cpu, latencies = measure(cache.clean, [pattern])
+        results.append(Result(workload, backend, entries, 0, seconds,
+                              cpu, latencies))
+    return results
+
+
+def bench_concurrent(bench, backend):
+    args = bench.args
+    size = args.medium_size * 2**20
+    paths = bench.files("medium", args.medium_files, size)
+    orders = []
+    for _ in range(args.readers):
+        order = list(paths)
+        bench.rng.shuffle(order)
+        orders.append(order)
+    cache = bench.cache(backend)
+    latencies = []
+
+    def _reader(order):
+        latencies.extend(measure(cache.read, order)[2])
+    seconds, cpu, _ = measure(_reader, orders, args.readers)
+    return [Result("concurrent/{}".format(args.readers), backend,
+                   len(latencies), len(latencies) * size, seconds, cpu,
+                   latencies)]
+
+
+def report(results, out):
+    """Write a table of *results* to the stream *out*"""
+    out.write("{:<20} {:<6} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}\n".format(
+        "workload", "backend", "ops", "MiB/s", "ops/s", "p50 ms", "p99 ms",
+        "CPU s/GiB"))
+    for r in results:
+        # the data rates don't apply to workloads without data
+        throughput = cpu = "-"
+        if r.nbytes:
+            throughput = "{:.1f}".format(r.nbytes / 2**20 / r.seconds)
+            cpu = "{:.2f}".format(r.cpu / (r.nbytes / 2**30))
+        out.write("{:<20} {:<6} {:>7} {:>9} {:>9.1f} {:>9.2f} {:>9.2f} "
+                  "{:>10}\n".format(
+                      r.workload, r.backend, r.ops, throughput,
+                      r.ops / r.seconds, percentile(r.latencies, .5) * 1000,
+                      percentile(r.latencies, .99) * 1000, cpu))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m pynetfscache.benchmarks",
+        description="Benchmark the caches against emulated network "
+        "filesystems")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma-separated workloads (default: all)")
+    parser.add_argument("--backends", default=",".join(BACKENDS),
+                        help="comma-separated backends (default: all)")
+    parser.add_argument("--latency", type=float, default=0.,
+                        help="round-trip latency of requests in ms")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="bandwidth of the link in MiB/s")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="threads retrieving files at once")
+    parser.add_argument("--small-files", type=int, default=2000)
+    parser.add_argument("--small-size", type=int, default=16 * 2**10,
+                        help="size of the small files in bytes")
+    parser.add_argument("--huge-files", type=int, default=4)
+    parser.add_argument("--huge-size", type=int, default=256,
+                        help="size of the huge files in MiB")
+    parser.add_argument("--medium-files", type=int, default=32)
+    parser.add_argument("--medium-size", type=int, default=4,
+                        help="size of the files of the concurrent readers "
+                        "in MiB")
+    parser.add_argument("--readers", type=int, default=8,
+                        help="number of concurrent readers")
+    parser.add_argument("--hit-ratio", type=float, default=.8)
+    parser.add_argument("--clean-entries", type=int, default=100000)
+    parser.add_argument("--port", type=int, default=17024,
+                        help="port of the SFTP server")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE",
+                        help="also write the results to FILE as JSON")
+    return parser
+
+
+def main(argv=None, out=sys.stdout):
+    args = _parser().parse_args(argv)
+    workloads = args.workloads.split(",")
+    backends = args.backends.split(",")
+    for name, known in [(workloads, WORKLOADS), (backends, BACKENDS)]:
+        unknown = set(name) - set(known)
+        if unknown:
+            raise SystemExit("Unknown {}, use some of {}".format(
+                ", ".join(sorted(unknown)), ", ".join(known)))
+    remote = tempfile.mkdtemp()
+    bench = _Bench(args, remote)
+    results = []
+    try:
+        for backend in backends:
+            if backend == "sftp":
+                try:
+                    import paramiko  # noqa: F401
+                    import sftpserver  # noqa: F401
+                except ImportError as err:
+                    out.write("Skipping the sftp backend: {}\n".format(err))
+                    continue
+            for workload in workloads:
+                results.extend(globals()["bench_" + workload](bench, backend))
+    finally:
+        bench.close()
+        shutil.rmtree(remote)
+    report(results, out)
+    if args.json:
+        with open(args.json, "w") as fd:
+            json.dump([dict([(key, value) for key, value in r._asdict().items()
+                             if key != "latencies"],
+                            p50=percentile(r.latencies, .5),
+                            p99=percentile(r.latencies, .99))
+                       for r in results], fd, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
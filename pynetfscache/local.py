@@ -2,12 +2,21 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
-import datetime
-import glob
 import os
 import shutil
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from ._base import FilesystemCache
+from ._copy import COPY_BUFSIZE, copyfd
+from ._files import publish
 
 
 class LocalFilesystemCache(FilesystemCache):
@@ -15,8 +24,21 @@ class LocalFilesystemCache(FilesystemCache):
 
     Useful for NFS mounts
 
+    Files are copied with the cheapest mechanism available (see
+    :func:`copyfd`), falling back to a loop over reads of *blocksize*
+    bytes.  Like :func:`shutil.copy2`, the permission bits and times
+    are copied, too.  Files are copied to a temporary file first,
+    which is renamed when it is complete, so that other processes
+    never see a partial copy.
+
     """
 
+    def __init__(self, sourcepath, temppath=None, keep_tmp=False,
+                 blocksize=COPY_BUFSIZE, **kwargs):
+        self.blocksize = blocksize
+        super(LocalFilesystemCache, self).__init__(sourcepath, temppath,
+                                                   keep_tmp, **kwargs)
+
     def _check_init(self):
         if not os.path.isdir(self.sourcepath):
             raise ValueError("The given source path '{}' doesn't "
@@ -25,21 +47,62 @@ class LocalFilesystemCache(FilesystemCache):
             raise ValueError("The given source path '{}' is "
                              "empty".format(self.sourcepath))
 
-    def _retrieve(self, path):
+    def _retrieve(self, path, hasher=None):
+        sourcepath = self._construct_sourcepath(path)
         temppath = self._construct_temppath(path)
-        self._prepare_targetpath(path)
-        shutil.copy2(self._construct_sourcepath(path), temppath)
-        self._files[path] = temppath, datetime.datetime.now()
-        # TODO: mote self._files[path] = ... to base class
+        # stat before copying, so that a change during the copy is
+        # detected on the next validation
+        with open(sourcepath, "rb") as fsrc:
+            st = os.fstat(fsrc.fileno())
+            self._prepare_targetpath(path)
+            with publish(temppath) as partpath:
+                with open(partpath, "wb") as fdst:
+                    copyfd(fsrc.fileno(), fdst.fileno(), st.st_size,
+                           self.blocksize, hasher, None if self.scheduler
+                           is None else self._throttle)
+                shutil.copystat(sourcepath, partpath)
+        return st, st.st_size
 
-    def glob(self, pathname):
-        return glob.glob(os.path.join(self.sourcepath, pathname))
+    def _stat(self, path):
+        return os.stat(self._construct_sourcepath(path))
 
-    def isdir(self, dirname):
-        return os.path.isdir(self._construct_sourcepath(dirname))
+    def _read_range(self, sourcepath, offset, length, write):
+        with open(sourcepath, "rb") as fsrc:
+            fsrc.seek(offset)
+            while length > 0:
+                self._throttle(min(self.blocksize, length))
+                data = fsrc.read(min(self.blocksize, length))
+                if not data:
+                    break
+                write(offset, data)
+                offset += len(data)
+                length -= len(data)
 
-    def isfile(self, filename):
-        return os.path.isfile(self._construct_sourcepath(filename))
+    def _listdir_stat(self, dirname):
+        if scandir is None:
+            return super(LocalFilesystemCache, self)._listdir_stat(dirname)
+        result = {}
+        for entry in scandir(self._construct_sourcepath(dirname)):
+            try:
+                result[entry.name] = entry.stat()
+            except OSError:
+                result[entry.name] = None  # e.g. a broken symlink
+        return result
 
-    def listdir(self, dirname):
-        return os.listdir(self._construct_sourcepath(dirname))
+    def _scandir(self, dirname):
+        sourcepath = self._construct_sourcepath(dirname)
+        mtime = os.stat(sourcepath).st_mtime
+        if scandir is None:
+            # the modes are stat'ed lazily, when they are needed
+            return mtime, dict.fromkeys(os.listdir(sourcepath))
+        modes = {}
+        for entry in scandir(sourcepath):
+            # is_dir() and is_file() use the file type from the
+            # directory entry and only stat symlinks
+            if entry.is_dir():
+                modes[entry.name] = stat.S_IFDIR
+            elif entry.is_file():
+                modes[entry.name] = stat.S_IFREG
+            else:
+                modes[entry.name] = None
+        return mtime, modes
@@ -2,16 +2,192 @@
 
 from __future__ import division, unicode_literals
 
-import datetime
+import errno
+import hashlib
+import itertools
+import os
+import re
+import socket
 import stat
+import threading
 
 try:
-    import paramiko
-    _PARAMIKO = True
-except ImportError:
-    _PARAMIKO = False
+    from shlex import quote
+except ImportError:  # Python 2
+    from pipes import quote
 
-from ._base import FilesystemCache
+from ._base import FilesystemCache, weakmethod
+from ._copy import copyfd, preallocate, pwrite
+from ._files import remove
+
+# paramiko and its crypto stack are slow to import, so they are only
+# imported when the first SFTPFilesystemCache is created
+paramiko = None
+# errors after which a connection cannot be used anymore
+_CONNECTION_ERRORS = ()
+
+# the coreutils commands computing the hashlib hash functions
+_CHECKSUM_COMMANDS = {"md5": "md5sum", "sha1": "sha1sum",
+                      "sha224": "sha224sum", "sha256": "sha256sum",
+                      "sha384": "sha384sum", "sha512": "sha512sum",
+                      "blake2b": "b2sum"}
+
+# the suffix which :meth:`SFTPFilesystemCache._partpath` appends to the
+# name of a partial download
+_PARTNAME = re.compile(r"\.\d+-[\d.]+(?:\.chunked|\.delta)?\.part$")
+
+# prints the SHA-1 of every block of a file; run on the server with
+# the filename and the block size as arguments
+_BLOCK_HASHES_SCRIPT = """\
+import hashlib, sys
+with open(sys.argv[1], "rb") as f:
+    while True:
+        block = f.read(int(sys.argv[2]))
+        if not block:
+            break
+        sys.stdout.write(hashlib.sha1(block).hexdigest() + "\\n")
+"""
+
+
+def _import_paramiko():
+    global paramiko, _CONNECTION_ERRORS
+    if paramiko is not None:
+        return
+    try:
+        import paramiko as module
+    except ImportError:
+        raise ImportError("Cannot import paramiko, which is needed for "
+                          "SFTPFilesystemCache")
+    _CONNECTION_ERRORS = (module.SSHException, EOFError, socket.error)
+    paramiko = module
+
+
+class SFTPConnectionPool(object):
+    """A thread-safe pool of persistent SFTP channels
+
+    Up to *size* authenticated ``SFTPClient`` channels are kept open,
+    distributed round-robin over *transports* SSH connections, each
+    created with the *connect* callable returning a connected
+    ``paramiko.SSHClient``.  Transports send a keepalive every
+    *keepalive* seconds.  Dead channels and transports are detected
+    when a channel is handed out and replaced transparently.
+
+    """
+
+    def __init__(self, connect, size=4, transports=1, keepalive=30):
+        self._connect = connect
+        self.size = size
+        self.transports = max(1, min(transports, size))
+        self.keepalive = keepalive
+        self._cond = threading.Condition()
+        self._clients = [None] * self.transports
+        self._client_locks = [threading.Lock()
+                              for _ in range(self.transports)]
+        self._slots = {}
+        self._slot_counter = itertools.count()
+        self._idle = []
+        self._nopen = 0
+        self._closed = False
+
+    @staticmethod
+    def _is_healthy(sftp):
+        channel = sftp.get_channel()
+        return not channel.closed and channel.get_transport().is_active()
+
+    def _open_channel(self, slot):
+        with self._client_locks[slot]:
+            client = self._clients[slot]
+            transport = client.get_transport() if client else None
+            if transport is None or not transport.is_active():
+                if client is not None:
+                    client.close()
+                client = self._connect()
+                transport = client.get_transport()
+                if self.keepalive:
+                    transport.set_keepalive(self.keepalive)
+                self._clients[slot] = client
+            return paramiko.SFTPClient.from_transport(transport)
+
+    def _discard(self, sftp):
+        self._slots.pop(sftp, None)
+        self._nopen -= 1
+        try:
+            sftp.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Return an open SFTP channel, waiting if all are in use"""
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise ValueError("The SFTP connection pool is closed")
+                while self._idle:
+                    sftp = self._idle.pop()
+                    if self._is_healthy(sftp):
+                        return sftp
+                    self._discard(sftp)
+                if self._nopen < self.size:
+                    self._nopen += 1
+                    slot = next(self._slot_counter) % self.transports
+                    break
+                self._cond.wait()
+        try:
+            sftp = self._open_channel(slot)
+        except BaseException:
+            with self._cond:
+                self._nopen -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._slots[sftp] = slot
+        return sftp
+
+    def release(self, sftp, broken=False):
+        """Return *sftp* to the pool; *broken* channels are closed"""
+        with self._cond:
+            if broken or self._closed or not self._is_healthy(sftp):
+                self._discard(sftp)
+            else:
+                self._idle.append(sftp)
+            self._cond.notify()
+
+    def call(self, func, retries=1):
+        """Call *func* with an SFTP channel and return its result
+
+        If the connection fails, the call is retried up to *retries*
+        times on a fresh channel.
+
+        """
+        for attempt in itertools.count():
+            sftp = self.acquire()
+            try:
+                result = func(sftp)
+            except _CONNECTION_ERRORS:
+                self.release(sftp, broken=True)
+                if attempt >= retries:
+                    raise
+            except BaseException:
+                self.release(sftp)
+                raise
+            else:
+                self.release(sftp)
+                return result
+
+    def close(self):
+        """Close all channels and transports"""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            clients, self._clients = self._clients, [None] * self.transports
+            self._cond.notify_all()
+        for client in clients:
+            if client is not None:
+                try:
+                    client.close()
+                except Exception:
+                    pass
 
 
 class SFTPFilesystemCache(FilesystemCache):
@@ -19,14 +195,52 @@ class SFTPFilesystemCache(FilesystemCache):
 
     This makes use of the paramiko library
 
+    SFTP channels are kept open in a :class:`SFTPConnectionPool` of
+    *connections* channels over *transports* SSH connections, and
+    closed when the cache is deleted.
+
+    Files are downloaded with pipelined reads, keeping up to *window*
+    bytes of read requests in flight, into a ``.part`` file that is
+    renamed once the transfer is complete and verified.  An
+    interrupted download is resumed from its ``.part`` file if the
+    remote file is unchanged.
+
+    Files of at least *chunk_threshold* bytes are split into chunks of
+    *chunk_size* bytes, which are downloaded on separate channels in
+    parallel.  Use *transports* > 1 to spread them over several SSH
+    connections.  A *chunk_threshold* of None disables this.
+
+    In checksum mode, sequential downloads are hashed as they stream;
+    chunked downloads, whose chunks arrive out of order, are hashed
+    once they are complete.  If *remote_checksum* is true and there is
+    no sidecar file, the checksum of the source is computed on the
+    server with ``sha256sum`` (or the coreutils command of the hash
+    function) over the SSH connection.  On servers which run no
+    commands, such as SFTP-only accounts, the copy is not checked.
+
+    A changed file of at least *delta_threshold* bytes whose previous
+    version is cached is updated with a delta transfer: the server
+    hashes the file in blocks of *delta_blocksize* bytes with a Python
+    script over the SSH connection, and only the blocks whose hashes
+    differ from the cached copy are downloaded.  This catches changes
+    in place and appended data, not shifted data.  If the server has
+    no Python, the file is downloaded completely.  A *delta_threshold*
+    of None disables this.
+
+    The SSH connection is only opened when it is first needed, unless
+    *lazy_connect* is false, in which case the connection is checked
+    right away.
+
     """
 
     def __init__(self, sourcepath, hostname, user, port=22, password=None,
                  ssh_id=None, ssh_hostkey=None, ssh_unknown_hosts=False,
-                 temppath=None, keep_tmp=False):
-        if not _PARAMIKO:
-            raise ImportError("Cannot import paramiko, which is needed for "
-                              "SFTPFilesystemCache")
+                 temppath=None, keep_tmp=False, connections=4, transports=1,
+                 keepalive=30, window=8 * 2**20, chunk_size=64 * 2**20,
+                 chunk_threshold=256 * 2**20, remote_checksum=False,
+                 delta_threshold=64 * 2**20, delta_blocksize=2**20,
+                 lazy_connect=True, **kwargs):
+        _import_paramiko()
         self._hostname = hostname
         self._username = user
         self._password = password
@@ -34,72 +248,359 @@ class SFTPFilesystemCache(FilesystemCache):
         # TODO: ssh_agent
         self._ssh_id = None
         self._port = port
-        self._ssh = paramiko.SSHClient()
-        self._ssh.load_system_host_keys()
-        if ssh_hostkey is not None:
-            self._ssh.load_host_keys(ssh_hostkey)
-        if ssh_unknown_hosts:
-            self._ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-        else:
-            self._ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
-        # TODO: persistently connect
+        self._ssh_hostkey = ssh_hostkey
+        self._ssh_unknown_hosts = ssh_unknown_hosts
+        self.window = window
+        self.chunk_size = chunk_size
+        self.chunk_threshold = chunk_threshold
+        self.remote_checksum = remote_checksum
+        self.delta_threshold = delta_threshold
+        self.delta_blocksize = delta_blocksize
+        self.lazy_connect = lazy_connect
+        self._chunk_pool = None
+        self._connections = SFTPConnectionPool(weakmethod(self._connect),
+                                               connections, transports,
+                                               keepalive)
         super(SFTPFilesystemCache, self).__init__(sourcepath, temppath,
-                                                  keep_tmp)
+                                                  keep_tmp, **kwargs)
 
     def __del__(self):
         self._disconnect()
         super(SFTPFilesystemCache, self).__del__()
 
     def _connect(self):
-        # TODO: check if connection already exists
-        self._ssh.connect(self._hostname, self._port, self._username,
-                          self._password, key_filename=self._ssh_id,
-                          compress=True)
-        self._sshtransport = self._ssh.get_transport()
-        self._sftp = paramiko.SFTPClient.from_transport(self._sshtransport)
+        ssh = paramiko.SSHClient()
+        ssh.load_system_host_keys()
+        if self._ssh_hostkey is not None:
+            ssh.load_host_keys(self._ssh_hostkey)
+        if self._ssh_unknown_hosts:
+            ssh.set_missing_host_key_policy(paramiko.WarningPolicy())
+        else:
+            ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
+        ssh.connect(self._hostname, self._port, self._username,
+                    self._password, key_filename=self._ssh_id,
+                    compress=True)
+        return ssh
 
     def _disconnect(self):
-        try:
-            self._sftp.close()
-        except:
-            pass
-        try:
-            self._sshtransport.close()
-        except:
-            pass
-        try:
-            self._ssh.close()
-        except:
-            pass
+        if getattr(self, "_chunk_pool", None) is not None:
+            self._chunk_pool.close()
+        if getattr(self, "_connections", None) is not None:
+            self._connections.close()
 
     def _check_init(self):
-        self._connect()
-        self._sftp.listdir(".")
-        self._disconnect()
+        if not self.lazy_connect:
+            self._connections.call(lambda sftp: sftp.listdir("."))
 
-    def _retrieve(self, path):
-        raise NotImplementedError()
+    def _retrieve(self, path, hasher=None):
+        sourcepath = self._construct_sourcepath(path)
         temppath = self._construct_temppath(path)
         self._prepare_targetpath(path)
-        self._files[path] = temppath, datetime.datetime.now()
+        st = self._connections.call(lambda sftp: sftp.stat(sourcepath))
+        nbytes = None
+        if (self.delta_threshold is not None and
+                st.st_size >= self.delta_threshold and
+                os.path.isfile(temppath)):
+            nbytes = self._download_delta(sourcepath, temppath, st)
+        if nbytes is None:
+            if (self.chunk_threshold is not None and
+                    st.st_size >= self.chunk_threshold):
+                nbytes = self._download_chunked(sourcepath, temppath, st)
+            else:
+                nbytes = self._connections.call(lambda sftp: self._download(
+                    sftp, sourcepath, temppath, st, hasher))
+                return st, nbytes
+        # delta and chunked downloads are hashed once they are complete
+        if hasher is not None:
+            hasher.restart(temppath)
+        return st, nbytes
+
+    @staticmethod
+    def _partpath(temppath, st, suffix=".part"):
+        # the remote size and mtime are part of the name, so that only
+        # partial downloads of the same version of a file are resumed
+        return "{}.{}-{}{}".format(temppath, st.st_size, st.st_mtime, suffix)
+
+    @staticmethod
+    def _remove_stale_parts(temppath, partpath):
+        """Remove the partial downloads of *temppath* except *partpath*
 
-    def glob(self, pathname):
-        raise NotImplementedError()
+        These are left behind by downloads of other versions of the
+        file, which can never be resumed.
+
+        """
+        dirname, basename = os.path.split(temppath)
+        for name in os.listdir(dirname):
+            if (name.startswith(basename) and
+                    _PARTNAME.match(name[len(basename):]) and
+                    os.path.join(dirname, name) != partpath):
+                remove(os.path.join(dirname, name))
+
+    def _iter_partial(self):
+        partial = []
+        for dirpath, dirnames, filenames in os.walk(self.temppath):
+            # skip the locks, blobs, sparse files and the hot tier
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith(".pynetfscache.")]
+            for name in filenames:
+                match = _PARTNAME.search(name)
+                if match is None or match.start() == 0:
+                    continue
+                partpath = os.path.join(dirpath, name)
+                relpath = os.path.relpath(partpath, self.temppath)
+                partial.append((relpath[:len(relpath) - len(match.group())],
+                                partpath))
+        return partial
+
+    def _download(self, sftp, sourcepath, temppath, st, hasher=None):
+        """Download *sourcepath*, resuming a partial download
+
+        Returns the number of bytes transferred.
+
+        """
+        partpath = self._partpath(temppath, st)
+        self._remove_stale_parts(temppath, partpath)
+        with sftp.open(sourcepath, "rb") as fsrc, \
+                open(partpath, "ab") as fdst:
+            fdst.seek(0, os.SEEK_END)
+            offset = fdst.tell()
+            if offset > st.st_size:
+                fdst.truncate(0)
+                offset = 0
+            if hasher is not None:
+                # the resumed part has to be hashed, too; this also
+                # covers data written by a failed attempt before a retry
+                hasher.restart(partpath)
+
+            def _write(pos, data):
+                fdst.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+            self._pipelined_copy(fsrc, _write, offset, st.st_size)
+        self._finish(partpath, temppath, st, sftp.stat(sourcepath))
+        return st.st_size - offset
+
+    def _download_chunked(self, sourcepath, temppath, st):
+        """Download *sourcepath* in chunks on several channels at once
+
+        The chunks are written to a preallocated ``.chunked.part``
+        file.  Unlike sequential downloads, interrupted chunked
+        downloads start over.
+
+        """
+        partpath = self._partpath(temppath, st, ".chunked.part")
+        self._remove_stale_parts(temppath, partpath)
+        fd = os.open(partpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            preallocate(fd, st.st_size)
+        finally:
+            os.close(fd)
+        chunks = [(start, min(start + self.chunk_size, st.st_size))
+                  for start in range(0, st.st_size, self.chunk_size)]
+        return self._fetch_ranges(sourcepath, partpath, chunks, temppath, st)
+
+    def _download_delta(self, sourcepath, temppath, st):
+        """Update the cached copy *temppath* with the changed blocks
+
+        Returns the number of bytes transferred, or None if the block
+        hashes of the remote file are not available.
+
+        """
+        output = self._exec("command -v python3 >/dev/null 2>&1 && exec "
+                            "python3 -c {0} {1} {2} || exec python -c {0} "
+                            "{1} {2}".format(quote(_BLOCK_HASHES_SCRIPT),
+                                             quote(sourcepath),
+                                             self.delta_blocksize))
+        if output is None:
+            return None
+        remote = output.decode("ascii").split()
+        blocksize = self.delta_blocksize
+        changed = []
+        with open(temppath, "rb") as fold:
+            for i, digest in enumerate(remote):
+                block = fold.read(blocksize)
+                if hashlib.sha1(block).hexdigest() != digest:
+                    changed.append(i)
+            oldsize = os.fstat(fold.fileno()).st_size
+            partpath = self._partpath(temppath, st, ".delta.part")
+            self._remove_stale_parts(temppath, partpath)
+            fd = os.open(partpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            try:
+                copyfd(fold.fileno(), fd, min(oldsize, st.st_size))
+                os.ftruncate(fd, st.st_size)
+            finally:
+                os.close(fd)
+        ranges = []
+        for i in changed:
+            start, end = i * blocksize, min((i + 1) * blocksize, st.st_size)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return self._fetch_ranges(sourcepath, partpath, ranges, temppath, st)
+
+    def _exec(self, command):
+        """Run *command* on the server and return its output
+
+        Returns None if the command fails, or if the server does not
+        run commands at all, as SFTP-only servers do.
+
+        """
+        def _run(sftp):
+            transport = sftp.get_channel().get_transport()
+            try:
+                channel = transport.open_session()
+                try:
+                    channel.exec_command(command)
+                    output = channel.makefile("rb").read()
+                    status = channel.recv_exit_status()
+                finally:
+                    channel.close()
+            except paramiko.SSHException:
+                # a refused command leaves the connection usable; the
+                # errors of a broken one are left to the pool
+                if not transport.is_active():
+                    raise
+                return None
+            return output if status == 0 else None
+        return self._connections.call(_run)
+
+    def _fetch_ranges(self, sourcepath, partpath, ranges, temppath, st):
+        """Fetch *ranges* of *sourcepath* into *partpath* on several channels
+
+        The complete download is moved to *temppath*; if a range
+        cannot be fetched, *partpath* is removed.  Returns the number
+        of bytes transferred.
+
+        """
+        @self._in_context
+        def _fetch(chunk):
+            return self._connections.call(lambda sftp: self._fetch_range(
+                sftp, sourcepath, partpath, chunk[0], chunk[1]))
+        try:
+            self._get_chunk_pool().map(_fetch, ranges)
+        except BaseException:
+            os.remove(partpath)
+            raise
+        st_after = self._connections.call(lambda sftp: sftp.stat(sourcepath))
+        self._finish(partpath, temppath, st, st_after)
+        return sum(end - start for start, end in ranges)
+
+    def _fetch_range(self, sftp, sourcepath, partpath, start, end):
+        fd = os.open(partpath, os.O_WRONLY)
+        try:
+            with sftp.open(sourcepath, "rb") as fsrc:
+                self._pipelined_copy(
+                    fsrc, lambda pos, data: pwrite(fd, data, pos),
+                    start, end)
+        finally:
+            os.close(fd)
+
+    def _get_chunk_pool(self):
+        with self._lock:
+            if self._chunk_pool is None:
+                # imported here, as multiprocessing is slow to import
+                from multiprocessing.pool import ThreadPool
+                self._chunk_pool = ThreadPool(self._connections.size)
+            return self._chunk_pool
+
+    @staticmethod
+    def _finish(partpath, temppath, st, st_after):
+        """Verify the download in *partpath* and move it to *temppath*"""
+        size = os.path.getsize(partpath)
+        if size != st.st_size or (st_after.st_size, st_after.st_mtime) != (
+                st.st_size, st.st_mtime):
+            os.remove(partpath)
+            raise IOError(errno.EIO, "Remote file changed or was truncated "
+                          "during the transfer", partpath)
+        os.chmod(partpath, stat.S_IMODE(st.st_mode))
+        os.utime(partpath, (st.st_atime, st.st_mtime))
+        os.rename(partpath, temppath)
+
+    def _pipelined_copy(self, fsrc, write, offset, end):
+        """Copy bytes *offset* to *end* of *fsrc* with *write*
+
+        *write* is called with the position and the data of each
+        block.  The range is requested in windows of :attr:`window`
+        bytes; within a window, all read requests are sent at once.
+
+        """
+        request = fsrc.MAX_REQUEST_SIZE
+        while offset < end:
+            stop = min(offset + self.window, end)
+            self._throttle(stop - offset)
+            chunks = [(pos, min(request, stop - pos))
+                      for pos in range(offset, stop, request)]
+            for (pos, _), data in zip(chunks, fsrc.readv(chunks)):
+                write(pos, data)
+            offset = stop
+
+    def _transfer_host(self):
+        return self._hostname
+
+    def _stat(self, path):
+        sourcepath = self._construct_sourcepath(path)
+        return self._connections.call(lambda sftp: sftp.stat(sourcepath))
+
+    def _read_range(self, sourcepath, offset, length, write):
+        def _read(sftp):
+            with sftp.open(sourcepath, "rb") as fsrc:
+                self._pipelined_copy(fsrc, write, offset, offset + length)
+        self._connections.call(_read)
+
+    def _remote_checksum(self, path, hashname):
+        digest = super(SFTPFilesystemCache, self)._remote_checksum(
+            path, hashname)
+        if (digest is not None or not self.remote_checksum or
+                hashname not in _CHECKSUM_COMMANDS):
+            return digest
+        output = self._exec("{} -- {}".format(
+            _CHECKSUM_COMMANDS[hashname],
+            quote(self._construct_sourcepath(path))))
+        if not output:
+            return None
+        return output.split()[0].decode("ascii").lower()
+
+    def _scandir(self, dirname):
+        sourcepath = self._construct_sourcepath(dirname)
+
+        def _list(sftp):
+            mtime = sftp.stat(sourcepath).st_mtime
+            # listdir_attr doesn't follow symlinks, so their targets'
+            # modes are stat'ed lazily
+            return mtime, dict(
+                (attr.filename,
+                 None if stat.S_ISLNK(attr.st_mode) else attr.st_mode)
+                for attr in sftp.listdir_attr(sourcepath))
+        return self._connections.call(_list)
+
+    def _listdir_stat(self, dirname):
+        sourcepath = self._construct_sourcepath(dirname)
+
+        def _list(sftp):
+            result = {}
+            for attr in sftp.listdir_attr(sourcepath):
+                name = attr.filename
+                if stat.S_ISLNK(attr.st_mode):
+                    # listdir_attr doesn't follow symlinks
+                    try:
+                        attr = sftp.stat(os.path.join(sourcepath, name))
+                    except IOError:
+                        attr = None
+                result[name] = attr
+            return result
+        return self._connections.call(_list)
+
+    def _mode(self, path):
+        mode = self._metadata.mode(path)
+        if mode is None:
+            raise IOError(errno.ENOENT, "No such file",
+                          self._construct_sourcepath(path))
+        return mode
 
     def isdir(self, dirname):
-        self._connect()
-        st = self._sftp.stat(self._construct_sourcepath(dirname))
-        self._disconnect()
-        return stat.S_ISDIR(st.st_mode)
+        return stat.S_ISDIR(self._mode(dirname))
 
     def isfile(self, filename):
-        self._connect()
-        st = self._sftp.stat(self._construct_sourcepath(filename))
-        self._disconnect()
-        return stat.S_ISREG(st.st_mode)
-
-    def listdir(self, dirname):
-        self._connect()
-        result = self._sftp.listdir(self._construct_sourcepath(dirname))
-        self._disconnect()
-        return result
+        return stat.S_ISREG(self._mode(filename))
@@ -4,18 +4,41 @@
 from __future__ import absolute_import, division, unicode_literals
 
 import datetime
+import errno
 import getpass
+import hashlib
+import io
+import mmap
 import os
 import shutil
+import socket
+import subprocess
+import sys
 import tempfile
-import thread
+import threading
 import time
 import unittest
 import warnings
 
-import sftpserver
+try:
+    import thread
+except ImportError:  # Python 3
+    import _thread as thread
 
-from pynetfscache import LocalFilesystemCache, SFTPFilesystemCache
+from sftpserver.stub_sftp import StubSFTPServer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pynetfscache import (LocalFilesystemCache, MetricsHook, RetrieveError,
+                          SFTPFilesystemCache, TransferScheduler,
+                          benchmarks)
+try:
+    import asyncio
+    from pynetfscache.aio import AsyncFilesystemCache
+except (ImportError, SyntaxError):  # Python < 3.6
+    AsyncFilesystemCache = None
 
 
 def _touch(path, createdirs=False):
@@ -27,6 +50,15 @@ def _touch(path, createdirs=False):
         os.utime(path, None)
 
 
+class _CountingCache(LocalFilesystemCache):
+    """A LocalFilesystemCache counting (and slowing down) its transfers"""
+
+    def _retrieve(self, path, hasher=None):
+        self.transfers = getattr(self, "transfers", 0) + 1
+        time.sleep(0.2)
+        return super(_CountingCache, self)._retrieve(path, hasher)
+
+
 class TestLocalFilesystemCache(unittest.TestCase):
     def setUp(self):
         self.remotebase = tempfile.mkdtemp()
@@ -70,7 +102,8 @@ class TestLocalFilesystemCache(unittest.TestCase):
         c.retrieve(["fileA", os.path.join("dirA", "fileA")])
         c.clean("f*")
         self.assertEqual(os.listdir(c.temppath), ["dirA"])
-        self.assertEqual(c._files.keys(), [os.path.join("dirA", "fileA")])
+        self.assertEqual(list(c._files.keys()),
+                         [os.path.join("dirA", "fileA")])
         del c
 
     def test_clean_datetime(self):
@@ -85,7 +118,8 @@ class TestLocalFilesystemCache(unittest.TestCase):
         time.sleep(0.5)
         c.clean(time=t0 + datetime.timedelta(milliseconds=100))
         self.assertEqual(os.listdir(c.temppath), ["dirA"])
-        self.assertEqual(c._files.keys(), [os.path.join("dirA", "fileA")])
+        self.assertEqual(list(c._files.keys()),
+                         [os.path.join("dirA", "fileA")])
         del c
 
     def test_clean_timedelta(self):
@@ -102,7 +136,8 @@ class TestLocalFilesystemCache(unittest.TestCase):
                      datetime.timedelta(microseconds=10))
         c.clean(time=timedelta)
         self.assertEqual(os.listdir(c.temppath), ["dirA"])
-        self.assertEqual(c._files.keys(), [os.path.join("dirA", "fileA")])
+        self.assertEqual(list(c._files.keys()),
+                         [os.path.join("dirA", "fileA")])
         del c
 
     # TODO: tests specific to LocalFSCache
@@ -140,6 +175,615 @@ class TestLocalFilesystemCache(unittest.TestCase):
         self.assertEqual(cm.exception.errno, 2)
         del c
 
+    def test_retrieve_file_list_errors(self):
+        c = LocalFilesystemCache(self.remotebase)
+        with self.assertRaises(RetrieveError) as cm:
+            c.retrieve(["fileB", "fileA", "fileC"])
+        self.assertEqual(list(cm.exception.errors.keys()), ["fileB", "fileC"])
+        self.assertEqual(cm.exception.errors["fileB"].errno, 2)
+        self.assertEqual(cm.exception.results,
+                         [None, os.path.join(c.temppath, "fileA"), None])
+        self.assertEqual(list(c._files.keys()), ["fileA"])
+        del c
+
+    def test_retrieve_file_iterable_parallel(self):
+        names = [os.path.join("dirB", "file{:03d}".format(i))
+                 for i in range(100)]
+        for name in names:
+            _touch(os.path.join(self.remotebase, name), createdirs=True)
+        c = LocalFilesystemCache(self.remotebase, workers=8)
+        lpaths = c.retrieve(name for name in names)
+        self.assertEqual(lpaths,
+                         [os.path.join(c.temppath, name) for name in names])
+        self.assertEqual(len(c._files), 100)
+        del c
+
+    def test_retrieve_glob(self):
+        for name in ["fileB", "fileC"]:
+            _touch(os.path.join(self.remotebase, "dirA", name))
+        c = LocalFilesystemCache(self.remotebase)
+        c.retrieve(os.path.join("dirA", "fileB"))
+        t0 = c._files[os.path.join("dirA", "fileB")][1]
+        lpaths = c(os.path.join("dir*", "file*"))
+        self.assertEqual(lpaths, [os.path.join(c.temppath, "dirA", name)
+                                  for name in ["fileA", "fileB", "fileC"]])
+        self.assertTrue(all(os.path.isfile(lpath) for lpath in lpaths))
+        self.assertEqual(c._files[os.path.join("dirA", "fileB")][1], t0)
+        self.assertEqual(c.retrieve("nomatch*"), [])
+        # directories are not retrieved
+        self.assertEqual(c("*"), [os.path.join(c.temppath, "fileA")])
+        del c
+
+    def test_hold_glob(self):
+        c = LocalFilesystemCache(self.remotebase)
+        with c.hold(os.path.join("dirA", "file*")) as lpaths:
+            c.clean()
+            self.assertTrue(all(os.path.isfile(lpath) for lpath in lpaths))
+        self.assertEqual(c._held, {})
+        del c
+
+    def test_retrieve_coalesced(self):
+        c = _CountingCache(self.remotebase, workers=8)
+        lpaths = c.retrieve(["fileA"] * 8)
+        self.assertEqual(lpaths, [os.path.join(c.temppath, "fileA")] * 8)
+        self.assertEqual(c.transfers, 1)
+        del c
+
+    def test_retrieve_coalesced_late(self):
+        class _LateCache(_CountingCache):
+            # another thread fetches the file between the lookup of the
+            # first one and the start of its flight
+            def _lookup(self, path):
+                entry = _CountingCache._lookup(self, path)
+                if not getattr(self, "raced", False):
+                    self.raced = True
+                    thread = threading.Thread(target=self.retrieve,
+                                              args=(path,))
+                    thread.start()
+                    thread.join()
+                return entry
+        c = _LateCache(self.remotebase)
+        self.assertEqual(c.retrieve("fileA"), os.path.join(c.temppath,
+                                                           "fileA"))
+        self.assertEqual(c.transfers, 1)
+        del c
+
+    def test_retrieve_shared(self):
+        c1 = _CountingCache(self.remotebase, self.localbase, keep_tmp=True,
+                            shared=True)
+        c2 = _CountingCache(self.remotebase, self.localbase, keep_tmp=True,
+                            shared=True)
+        c1.retrieve("fileA")
+        self.assertEqual(c2.retrieve("fileA"), c1.retrieve("fileA"))
+        self.assertEqual(getattr(c2, "transfers", 0), 0)
+        with open(os.path.join(self.remotebase, "fileA"), "w") as fd:
+            fd.write("changed")
+        c2.retrieve("fileA")
+        self.assertEqual(c2.transfers, 1)
+        del c1, c2
+
+    def test_shared_lease(self):
+        c1 = LocalFilesystemCache(self.remotebase, self.localbase,
+                                  keep_tmp=True, shared=True)
+        c2 = LocalFilesystemCache(self.remotebase, self.localbase,
+                                  keep_tmp=True, shared=True)
+        with c1.hold("fileA") as lpath:
+            c2.retrieve("fileA")
+            c2.clean()
+            self.assertTrue(os.path.isfile(lpath))
+            self.assertEqual(list(c2._files.keys()), ["fileA"])
+        c2.clean()
+        self.assertFalse(os.path.isfile(lpath))
+        self.assertEqual(c1.retrieve("fileA"), lpath)
+        self.assertTrue(os.path.isfile(lpath))
+        del c1, c2
+
+    def test_shared_needs_temppath(self):
+        with self.assertRaises(ValueError):
+            LocalFilesystemCache(self.remotebase, shared=True)
+
+    def test_prefetch(self):
+        c = LocalFilesystemCache(self.remotebase)
+        c.prefetch(["fileA", os.path.join("dirA", "fileA"), "fileB"])
+        c._prefetcher.wait()
+        self.assertEqual(sorted(c._files.keys()),
+                         [os.path.join("dirA", "fileA"), "fileA"])
+        del c
+
+    def test_prefetch_predict(self):
+        for i in range(1, 6):
+            _touch(os.path.join(self.remotebase, "dirB",
+                                "day_{:03d}.nc".format(i)), createdirs=True)
+        c = LocalFilesystemCache(self.remotebase, predict=2)
+        c.retrieve(os.path.join("dirB", "day_001.nc"))
+        c._prefetcher.wait()
+        self.assertEqual(len(c._files), 1)
+        c.retrieve(os.path.join("dirB", "day_002.nc"))
+        c._prefetcher.wait()
+        self.assertEqual(sorted(c._files.keys()),
+                         [os.path.join("dirB", "day_00{}.nc".format(i))
+                          for i in range(1, 5)])
+        del c
+
+    def test_content_addressed(self):
+        with open(os.path.join(self.remotebase, "dirA", "data"), "w") as fd:
+            fd.write("data")
+        shutil.copy(os.path.join(self.remotebase, "dirA", "data"),
+                    os.path.join(self.remotebase, "data"))
+        os.symlink(os.path.join(self.remotebase, "dirA"),
+                   os.path.join(self.remotebase, "dirC"))
+        c = _CountingCache(self.remotebase, content_addressed="sha256")
+        lpaths = c.retrieve([os.path.join("dirA", "data"), "data"])
+        self.assertEqual(c.transfers, 2)
+        lpaths.append(c.retrieve(os.path.join("dirC", "data")))
+        self.assertEqual(c.transfers, 2)
+        self.assertEqual(len(set(os.stat(p).st_ino for p in lpaths)), 1)
+        with open(lpaths[-1]) as fd:
+            self.assertEqual(fd.read(), "data")
+        c.clean("data")
+        self.assertEqual(c.retrieve("data"), lpaths[1])
+        self.assertEqual(c.transfers, 2)
+        c.clean()
+        blobs = os.path.join(c.temppath, ".pynetfscache.blobs")
+        self.assertEqual([f for _, _, files in os.walk(blobs) for f in files],
+                         [])
+        del c
+
+    def test_content_addressed_devices(self):
+        class _Stat(object):
+            pass
+
+        with open(os.path.join(self.remotebase, "dirA", "data"), "w") as fd:
+            fd.write("data")
+        with open(os.path.join(self.remotebase, "other"), "w") as fd:
+            fd.write("atad")
+
+        class _OtherDeviceCache(_CountingCache):
+            # "other" looks like "dirA/data" on another device
+            def _stat(self, path):
+                if path != "other":
+                    return _CountingCache._stat(self, path)
+                real = os.stat(os.path.join(self.sourcepath, "dirA", "data"))
+                st = _Stat()
+                for name in dir(real):
+                    if name.startswith("st_"):
+                        setattr(st, name, getattr(real, name))
+                st.st_dev += 1
+                return st
+        c = _OtherDeviceCache(self.remotebase, content_addressed=True)
+        c.retrieve(os.path.join("dirA", "data"))
+        with open(c.retrieve("other")) as fd:
+            self.assertEqual(fd.read(), "atad")
+        self.assertEqual(c.transfers, 2)
+        del c
+
+    def test_compression(self):
+        data = b"compressible " * 10000
+        with open(os.path.join(self.remotebase, "data.csv"), "wb") as fd:
+            fd.write(data)
+        c = LocalFilesystemCache(
+            self.remotebase, compression=[("*.csv", "gzip", 9),
+                                          ("*", "bz2")])
+        lpath = c.retrieve("data.csv")
+        with open(lpath, "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        stored = os.path.join(c.temppath, "data.csv.gz")
+        self.assertTrue(os.path.isfile(stored))
+        self.assertFalse(os.path.exists(os.path.join(c.temppath, "data.csv")))
+        self.assertLess(os.path.getsize(stored), len(data) // 10)
+        with c.open("data.csv") as fd:
+            self.assertEqual(fd.read(), data)
+        c.retrieve("fileA")
+        self.assertTrue(os.path.isfile(os.path.join(c.temppath, "fileA.bz2")))
+        c.clean("data.csv")
+        self.assertFalse(os.path.exists(stored))
+        self.assertFalse(os.path.exists(lpath))
+        del c
+
+    def test_compression_shared(self):
+        data = b"compressible " * 100000
+        with open(os.path.join(self.remotebase, "big"), "wb") as fd:
+            fd.write(data)
+        caches = [LocalFilesystemCache(self.remotebase, self.localbase,
+                                       keep_tmp=True, shared=True,
+                                       compression="bz2")
+                  for _ in range(4)]
+        errors = []
+
+        def _retrieve(c):
+            try:
+                with open(c.retrieve("big"), "rb") as fd:
+                    self.assertEqual(fd.read(), data)
+            except Exception as err:
+                errors.append(err)
+        threads = [threading.Thread(target=_retrieve, args=(c,))
+                   for c in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertFalse(os.path.exists(os.path.join(self.localbase, "big")))
+        del caches
+
+    def test_compression_shared_adopt(self):
+        data = b"compressible " * 100000
+        with open(os.path.join(self.remotebase, "big"), "wb") as fd:
+            fd.write(data)
+        caches = [_CountingCache(self.remotebase, self.localbase,
+                                 keep_tmp=True, shared=True,
+                                 compression="gzip", checksum=True)
+                  for _ in range(4)]
+        threads = [threading.Thread(target=c.retrieve, args=("big",))
+                   for c in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the compressed copy of the first is adopted by the others
+        self.assertEqual(sum(getattr(c, "transfers", 0) for c in caches), 1)
+        digests = set(c._files["big"].checksum for c in caches)
+        self.assertEqual(digests, set([hashlib.sha256(data).hexdigest()]))
+        for c in caches:
+            with open(c.retrieve("big"), "rb") as fd:
+                self.assertEqual(fd.read(), data)
+        del caches
+
+    def test_compression_hot_ttl(self):
+        c = LocalFilesystemCache(self.remotebase, compression="gzip",
+                                 hot_ttl=0.2)
+        lpath = c.retrieve("fileA")
+        self.assertTrue(os.path.isfile(lpath))
+        time.sleep(0.3)
+        c.retrieve(os.path.join("dirA", "fileA"))
+        self.assertFalse(os.path.exists(lpath))
+        self.assertEqual(c.retrieve("fileA"), lpath)
+        self.assertTrue(os.path.isfile(lpath))
+        del c
+
+    def test_open_lazy(self):
+        data = os.urandom(2**20 + 17)
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(data)
+        c = _CountingCache(self.remotebase, range_blocksize=2**16,
+                           readahead=1)
+        with c.open("fileB") as fd:
+            fd.seek(2**18 + 10)
+            self.assertEqual(fd.read(100), data[2**18 + 10:2**18 + 110])
+            self.assertEqual(c._sparse["fileB"].missing, 17 - 2)
+            fd.seek(-17, os.SEEK_END)
+            self.assertEqual(fd.read(), data[-17:])
+            self.assertNotIn("fileB", c._files)
+            fd.seek(0)
+            self.assertEqual(fd.read(), data)
+        self.assertEqual(c._sparse, {})
+        lpath = c.retrieve("fileB")
+        self.assertEqual(getattr(c, "transfers", 0), 0)
+        with open(lpath, "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        with c.open("fileB") as fd:
+            self.assertEqual(fd.read(), data)
+        del c
+
+    def test_open_lazy_shared(self):
+        data = os.urandom(2**18)
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(data)
+        temppath = tempfile.mkdtemp()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            c1 = LocalFilesystemCache(self.remotebase, temppath, shared=True,
+                                      range_blocksize=2**16, readahead=0)
+            c2 = LocalFilesystemCache(self.remotebase, temppath, shared=True,
+                                      range_blocksize=2**16, readahead=0)
+        with c1.open("fileB") as fd:
+            self.assertEqual(fd.read(100), data[:100])
+        with c2.open("fileB") as fd:
+            fd.seek(2**16)
+            self.assertEqual(fd.read(100), data[2**16:2**16 + 100])
+        with c1.open("fileB") as fd:
+            self.assertEqual(fd.read(100), data[:100])
+        del c1, c2
+        shutil.rmtree(temppath)
+
+    def test_open_lazy_orphans(self):
+        sourcepath = os.path.join(self.remotebase, "fileB")
+        with open(sourcepath, "wb") as fd:
+            fd.write(os.urandom(2**17))
+        temppath = tempfile.mkdtemp()
+        sparsedir = os.path.join(temppath, ".pynetfscache.sparse")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            c1 = LocalFilesystemCache(self.remotebase, temppath, shared=True,
+                                      range_blocksize=2**16, readahead=0)
+            c2 = LocalFilesystemCache(self.remotebase, temppath, shared=True,
+                                      range_blocksize=2**16, readahead=0)
+        fd1 = c1.open("fileB")
+        fd1.read(100)
+        old = c1._sparse["fileB"].filename
+        # a new version of the source replaces the sparse file
+        data = os.urandom(2**17)
+        with open(sourcepath, "wb") as fd:
+            fd.write(data)
+        st = os.stat(sourcepath)
+        os.utime(sourcepath, (st.st_atime, st.st_mtime + 10))
+        fd2 = c1.open("fileB")
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(os.listdir(sparsedir),
+                         [os.path.basename(c1._sparse["fileB"].filename)])
+        # one left behind by an earlier process
+        orphan = os.path.join(sparsedir, "fileB.abcdefgh.sparse")
+        _touch(orphan)
+        c2.clean("fileA")
+        self.assertTrue(os.path.exists(orphan))
+        c2.clean("fileB")
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(c1._sparse["fileB"].filename))
+        self.assertEqual(fd2.read(), data)
+        fd1.close(), fd2.close()
+        del c1, c2
+        shutil.rmtree(temppath)
+
+    def test_open_lazy_clean(self):
+        c = LocalFilesystemCache(self.remotebase)
+        fd = c.open(os.path.join("dirA", "fileA"))
+        sparsepath = c._sparse[os.path.join("dirA", "fileA")].filename
+        self.assertTrue(os.path.isfile(sparsepath))
+        c.clean("dirA")
+        self.assertFalse(os.path.exists(sparsepath))
+        self.assertEqual(fd.read(), b"")
+        fd.close()
+        del c
+
+    def test_mmap(self):
+        data = os.urandom(3 * mmap.ALLOCATIONGRANULARITY)
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(data)
+        c = LocalFilesystemCache(self.remotebase)
+        offset = mmap.ALLOCATIONGRANULARITY + 10
+        with c.mmap("fileB", offset, 100) as view:
+            self.assertEqual(bytes(view), data[offset:offset + 100])
+            c.clean()
+            self.assertIn("fileB", c._files)
+        with c.mmap("fileB", offset) as view:
+            self.assertEqual(bytes(view), data[offset:])
+        with c.mmap("fileA") as view:
+            self.assertEqual(len(view), 0)
+        c.clean()
+        self.assertEqual(c._files, {})
+        del c
+
+    @unittest.skipIf(numpy is None, "requires numpy")
+    def test_mmap_numpy(self):
+        required = numpy.arange(1000, dtype="<f8")
+        with open(os.path.join(self.remotebase, "data.raw"), "wb") as fd:
+            fd.write(required.tobytes())
+        c = LocalFilesystemCache(self.remotebase)
+        with c.mmap("data.raw", 80, dtype="<f8") as array:
+            self.assertTrue((array == required[10:]).all())
+            self.assertFalse(array.flags.writeable)
+        del c
+
+    def test_checksum(self):
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(b"data")
+        required = hashlib.sha256(b"data").hexdigest()
+        c = LocalFilesystemCache(self.remotebase, checksum=True)
+        lpath = c.retrieve("fileB")
+        self.assertEqual(c._files["fileB"].checksum, required)
+        with open(lpath, "wb") as fd:
+            fd.write(b"dat")
+        self.assertEqual(c.verify(), ["fileB"])
+        self.assertNotIn("fileB", c._files)
+        self.assertEqual(c.verify(), [])
+        del c
+
+    def test_checksum_sidecar(self):
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(b"data")
+        with open(os.path.join(self.remotebase, "fileB.sha1"), "w") as fd:
+            fd.write("{}  fileB\n".format(hashlib.sha1(b"data").hexdigest()))
+        with open(os.path.join(self.remotebase, "fileA.sha1"), "w") as fd:
+            fd.write("{}  fileA\n".format(hashlib.sha1(b"data").hexdigest()))
+        c = LocalFilesystemCache(self.remotebase, checksum="sha1")
+        c.retrieve("fileB")
+        with self.assertRaises(IOError) as cm:
+            c.retrieve("fileA")
+        self.assertIn("Checksum mismatch", str(cm.exception))
+        self.assertNotIn("fileA", c._files)
+        self.assertFalse(os.path.exists(os.path.join(c.temppath, "fileA")))
+        del c
+
+    def test_sync(self):
+        for name in ["data1.nc", "data2.nc", "notes.txt"]:
+            _touch(os.path.join(self.remotebase, "dirA", "dirB", name),
+                   createdirs=True)
+        c = _CountingCache(self.remotebase, workers=1)
+        self.assertEqual(c.sync("dirA", "*.nc"),
+                         [os.path.join("dirA", "dirB", "data1.nc"),
+                          os.path.join("dirA", "dirB", "data2.nc")])
+        self.assertEqual(c.sync("dirA"),
+                         [os.path.join("dirA", "dirB", "notes.txt"),
+                          os.path.join("dirA", "fileA")])
+        self.assertEqual(c.transfers, 4)
+        self.assertEqual(c.sync("dirA"), [])
+        with open(os.path.join(self.remotebase, "dirA", "fileA"), "w") as fd:
+            fd.write("changed")
+        os.remove(os.path.join(self.remotebase, "dirA", "dirB", "data2.nc"))
+        self.assertEqual(c.sync("dirA", delete=True),
+                         [os.path.join("dirA", "fileA")])
+        self.assertEqual(c.transfers, 5)
+        self.assertNotIn(os.path.join("dirA", "dirB", "data2.nc"), c._files)
+        with open(c.retrieve(os.path.join("dirA", "fileA"))) as fd:
+            self.assertEqual(fd.read(), "changed")
+        del c
+
+    @unittest.skipIf(sys.version_info < (3, 7),
+                     "requires module __getattr__ (Python 3.7)")
+    def test_lazy_import(self):
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, pynetfscache; "
+            "print('pynetfscache.sftp' in sys.modules); "
+            "from pynetfscache import SFTPFilesystemCache; "
+            "print('paramiko' in sys.modules)"])
+        self.assertEqual(output.split(), [b"False", b"False"])
+
+    def test_lazy_import_dependencies(self):
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys; from pynetfscache import SFTPFilesystemCache; "
+            "print('paramiko' in sys.modules); "
+            "print('multiprocessing.pool' in sys.modules)"])
+        self.assertEqual(output.split(), [b"False", b"False"])
+
+    def test_memory_tier(self):
+        for name, size in [("fileB", 100), ("fileC", 100)]:
+            with open(os.path.join(self.remotebase, name), "wb") as fd:
+                fd.write(name.encode("ascii") * size)
+        c = LocalFilesystemCache(self.remotebase, memory_bytes=800,
+                                 promote_hits=2)
+        self.assertEqual(c.read("fileB"), b"fileB" * 100)
+        self.assertNotIn("fileB", c._memory)
+        c.read("fileB")
+        self.assertIn("fileB", c._memory)
+        os.remove(os.path.join(c.temppath, "fileB"))
+        self.assertEqual(c.read("fileB"), b"fileB" * 100)
+        self.assertEqual(c.stats()["memory_hits"], 1)
+        c.read("fileC")
+        c.read("fileC")
+        self.assertNotIn("fileC", c._memory)  # demoted right away
+        c.read("fileC")
+        c.read("fileC")
+        self.assertIn("fileC", c._memory)
+        self.assertNotIn("fileB", c._memory)
+        self.assertEqual(c.stats()["memory_bytes"], 500)
+        c.clean("fileC")
+        self.assertNotIn("fileC", c._memory)
+        del c
+
+    def test_scheduler_bandwidth(self):
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(b"x" * 2**20)
+        scheduler = TransferScheduler(bandwidth=2**20, burst=2**19)
+        c = LocalFilesystemCache(self.remotebase, blocksize=2**16,
+                                 scheduler=scheduler)
+        start = time.time()
+        c.retrieve("fileB")
+        self.assertGreater(time.time() - start, .2)
+        scheduler.set_bandwidth(None)
+        with open(os.path.join(self.remotebase, "fileB"), "ab") as fd:
+            fd.write(b"x" * 2**20)
+        start = time.time()
+        c.retrieve("fileB")
+        self.assertLess(time.time() - start, .2)
+        del c
+
+    def test_scheduler_order(self):
+        scheduler = TransferScheduler(max_transfers=1)
+        order = []
+
+        def _transfer(priority, caller):
+            with scheduler.slot("host", priority, caller):
+                order.append((priority, caller))
+        with scheduler.slot("host"):
+            threads = []
+            for priority, caller in [("prefetch", 1), ("foreground", 2),
+                                     ("foreground", 2), ("foreground", 3),
+                                     ("sync", 4)]:
+                thread = threading.Thread(target=_transfer,
+                                          args=(priority, caller))
+                thread.start()
+                threads.append(thread)
+                time.sleep(.05)
+            with scheduler.slot("other"):
+                pass  # other hosts are not held up
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [("foreground", 2), ("foreground", 3),
+                                 ("foreground", 2), ("sync", 4),
+                                 ("prefetch", 1)])
+
+    def test_scheduler_boost(self):
+        priorities = []
+        joined = threading.Event()
+
+        class _Scheduler(TransferScheduler):
+            def consume(self, nbytes, priority="foreground", caller=None):
+                priorities.append(priority)
+                if len(priorities) == 1:
+                    joined.wait(5)
+                super(_Scheduler, self).consume(nbytes, priority, caller)
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(b"x" * 4000)
+        c = LocalFilesystemCache(self.remotebase, blocksize=1000,
+                                 scheduler=_Scheduler())
+
+        def _prefetch(cache):
+            with cache._scheduled("prefetch"):
+                cache.retrieve("fileB")
+        prefetch = threading.Thread(target=_prefetch, args=(c,))
+        prefetch.start()
+        while not priorities:
+            time.sleep(.01)
+        # a foreground retrieval joins the prefetch in flight
+        foreground = threading.Thread(target=c.retrieve, args=("fileB",))
+        foreground.start()
+        while not c.stats().get("coalesced"):
+            time.sleep(.01)
+        joined.set()
+        prefetch.join(), foreground.join()
+        self.assertEqual(priorities[0], "prefetch")
+        self.assertEqual(priorities[-1], "foreground")
+        del c
+
+    def test_benchmarks(self):
+        out = io.StringIO()
+        results = benchmarks.main(
+            ["--backends", "local", "--latency", "1", "--bandwidth", "100",
+             "--small-files", "20", "--huge-files", "1", "--huge-size", "1",
+             "--medium-files", "2", "--medium-size", "1", "--readers", "2",
+             "--clean-entries", "100"], out)
+        self.assertEqual([r.workload for r in results],
+                         ["small_files/miss", "small_files/hit",
+                          "huge_files/miss", "hit_miss/0.8", "clean/pattern",
+                          "clean/all", "concurrent/2"])
+        self.assertEqual(len(out.getvalue().splitlines()), 8)
+
+    def test_stats(self):
+        class _Hook(MetricsHook):
+            def __init__(self):
+                self.events = []
+
+            def count(self, name, value):
+                self.events.append((name, value))
+
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(b"data")
+        c = LocalFilesystemCache(self.remotebase, max_files=1, workers=1)
+        hook = _Hook()
+        c.metrics.add_hook(hook)
+        c.retrieve(["fileB", "fileB"])
+        c.retrieve("fileA")
+        c.clean()
+        stats = c.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+        self.assertEqual(stats["bytes_fetched"], 4)
+        self.assertEqual(stats["bytes_served"], 4)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["fetch_seconds"]["count"], 2)
+        self.assertEqual(stats["clean_seconds"]["count"], 1)
+        self.assertEqual((stats["files"], stats["inflight"]), (0, 0))
+        self.assertEqual(stats["backend"], "LocalFilesystemCache")
+        self.assertIn(("evictions", 1), hook.events)
+        del c
+
+    def test_compression_invalid(self):
+        self.assertRaises(ValueError, LocalFilesystemCache, self.remotebase,
+                          compression="nonexistent")
+        self.assertRaises(ValueError, LocalFilesystemCache, self.remotebase,
+                          compression="gzip", content_addressed=True)
+
     def test_retrieve_file_call(self):
         c = LocalFilesystemCache(self.remotebase)
         tmppath = c.temppath
@@ -163,6 +807,141 @@ class TestLocalFilesystemCache(unittest.TestCase):
         self.assertEqual(lpath, os.path.join(tmppath, "dirA", "fileA"))
         del c
 
+    def test_retrieve_content(self):
+        data = os.urandom(3 * 2**20 + 17)
+        with open(os.path.join(self.remotebase, "fileB"), "wb") as fd:
+            fd.write(data)
+        os.chmod(os.path.join(self.remotebase, "fileB"), 0o640)
+        c = LocalFilesystemCache(self.remotebase, blocksize=2**16)
+        lpath = c.retrieve("fileB")
+        with open(lpath, "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        st_src = os.stat(os.path.join(self.remotebase, "fileB"))
+        st_dst = os.stat(lpath)
+        self.assertEqual(st_dst.st_mode, st_src.st_mode)
+        self.assertEqual(int(st_dst.st_mtime), int(st_src.st_mtime))
+        del c
+
+    def test_retrieve_hit(self):
+        c = LocalFilesystemCache(self.remotebase)
+        c.retrieve("fileA")
+        t0 = c._files["fileA"][1]
+        lpath = c.retrieve("fileA")
+        self.assertEqual(c._files["fileA"][1], t0)
+        self.assertEqual(lpath, c("fileA"))
+        self.assertEqual(c._files["fileA"][1], t0)
+        del c
+
+    def test_retrieve_changed(self):
+        c = LocalFilesystemCache(self.remotebase)
+        lpath = c.retrieve("fileA")
+        t0 = c._files["fileA"][1]
+        with open(os.path.join(self.remotebase, "fileA"), "w") as fd:
+            fd.write("changed")
+        self.assertEqual(c.retrieve("fileA"), lpath)
+        self.assertTrue(c._files["fileA"][1] > t0)
+        with open(lpath) as fd:
+            self.assertEqual(fd.read(), "changed")
+        del c
+
+    def test_validate_never(self):
+        c = LocalFilesystemCache(self.remotebase, validate="never")
+        lpath = c.retrieve("fileA")
+        with open(os.path.join(self.remotebase, "fileA"), "w") as fd:
+            fd.write("changed")
+        c.retrieve("fileA")
+        self.assertEqual(os.path.getsize(lpath), 0)
+        del c
+
+    def test_validate_interval(self):
+        c = LocalFilesystemCache(self.remotebase, validate=0.5)
+        lpath = c.retrieve("fileA")
+        with open(os.path.join(self.remotebase, "fileA"), "w") as fd:
+            fd.write("changed")
+        c.retrieve("fileA")
+        self.assertEqual(os.path.getsize(lpath), 0)
+        time.sleep(0.6)
+        c.retrieve("fileA")
+        self.assertEqual(os.path.getsize(lpath), 7)
+        del c
+
+    def test_validate_invalid(self):
+        with self.assertRaises(ValueError):
+            LocalFilesystemCache(self.remotebase, validate="sometimes")
+
+    def test_persist(self):
+        c = LocalFilesystemCache(self.remotebase, self.localbase,
+                                 keep_tmp=True)
+        lpath = c.retrieve(os.path.join("dirA", "fileA"))
+        t0 = c._files[os.path.join("dirA", "fileA")][1]
+        del c
+        c = LocalFilesystemCache(self.remotebase, self.localbase,
+                                 keep_tmp=True)
+        self.assertEqual(list(c._files.keys()),
+                         [os.path.join("dirA", "fileA")])
+        self.assertEqual(c.retrieve(os.path.join("dirA", "fileA")), lpath)
+        self.assertEqual(c._files[os.path.join("dirA", "fileA")][1], t0)
+        c.clean()
+        del c
+        c = LocalFilesystemCache(self.remotebase, self.localbase,
+                                 keep_tmp=True)
+        self.assertEqual(c._files, {})
+        del c
+
+    def test_persist_disabled(self):
+        c = LocalFilesystemCache(self.remotebase, self.localbase,
+                                 keep_tmp=True, persist=False)
+        c.retrieve("fileA")
+        self.assertEqual(os.listdir(self.localbase), ["fileA"])
+        del c
+
+    def test_autoclean_max_files(self):
+        c = LocalFilesystemCache(self.remotebase, max_files=1)
+        c.retrieve("fileA")
+        c.retrieve(os.path.join("dirA", "fileA"))
+        self.assertEqual(list(c._files.keys()),
+                         [os.path.join("dirA", "fileA")])
+        self.assertEqual(os.listdir(c.temppath), ["dirA"])
+        del c
+
+    def test_autoclean_max_bytes(self):
+        for name in ["fileB", "fileC", "fileD"]:
+            with open(os.path.join(self.remotebase, name), "w") as fd:
+                fd.write("x" * 10)
+        c = LocalFilesystemCache(self.remotebase, max_bytes=25)
+        c.retrieve(["fileB", "fileC"])
+        c.retrieve("fileB")
+        c.retrieve("fileD")
+        self.assertEqual(sorted(c._files.keys()), ["fileB", "fileD"])
+        del c
+
+    def test_autoclean_lfu(self):
+        for name in ["fileB", "fileC"]:
+            _touch(os.path.join(self.remotebase, name))
+        c = LocalFilesystemCache(self.remotebase, max_files=2,
+                                 eviction="lfu")
+        c.retrieve(["fileA", "fileB"])
+        c.retrieve(["fileA", "fileB", "fileA"])
+        c.retrieve("fileC")
+        self.assertEqual(sorted(c._files.keys()), ["fileA", "fileC"])
+        del c
+
+    def test_autoclean_hold(self):
+        c = LocalFilesystemCache(self.remotebase, max_files=1)
+        with c.hold("fileA") as lpath:
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter("always")
+                c.retrieve(os.path.join("dirA", "fileA"))
+                self.assertTrue(str(w[-1].message).find("in use") > -1)
+            self.assertTrue(os.path.isfile(lpath))
+        self.assertEqual(c.autoclean(), ["fileA"])
+        del c
+
+    def test_autoclean_invalid(self):
+        with self.assertRaises(ValueError):
+            LocalFilesystemCache(self.remotebase, max_files=1,
+                                 eviction="random")
+
     def test_glob(self):
         def _abspath(filenames):
             return [os.path.join(self.remotebase, p) for p in filenames]
@@ -179,6 +958,41 @@ class TestLocalFilesystemCache(unittest.TestCase):
         self.assertEqual(actual, required)
         del c
 
+    def test_glob_nested(self):
+        _touch(os.path.join(self.remotebase, "dirB", "fileB"),
+               createdirs=True)
+        _touch(os.path.join(self.remotebase, "dirA", ".fileC"))
+        c = LocalFilesystemCache(self.remotebase)
+        self.assertEqual(c.glob(os.path.join("dir*", "file?")),
+                         [os.path.join(self.remotebase, "dirA", "fileA"),
+                          os.path.join(self.remotebase, "dirB", "fileB")])
+        self.assertEqual(c.glob(os.path.join("dirA", "*")),
+                         [os.path.join(self.remotebase, "dirA", "fileA")])
+        self.assertEqual(c.glob(os.path.join("dirA", ".*")),
+                         [os.path.join(self.remotebase, "dirA", ".fileC")])
+        self.assertEqual(c.glob(os.path.join("fileA", "*")), [])
+        del c
+
+    def test_metadata_ttl(self):
+        c = LocalFilesystemCache(self.remotebase, metadata_ttl=60)
+        self.assertFalse(c.isfile("fileB"))
+        _touch(os.path.join(self.remotebase, "fileB"))
+        self.assertFalse(c.isfile("fileB"))
+        self.assertEqual(sorted(c.listdir("")), ["dirA", "fileA"])
+        c._metadata.invalidate()
+        self.assertTrue(c.isfile("fileB"))
+        del c
+
+    def test_metadata_mtime(self):
+        c = LocalFilesystemCache(self.remotebase, metadata_ttl=0)
+        self.assertEqual(sorted(c.listdir("dirA")), ["fileA"])
+        st = os.stat(os.path.join(self.remotebase, "dirA"))
+        _touch(os.path.join(self.remotebase, "dirA", "fileB"))
+        os.utime(os.path.join(self.remotebase, "dirA"),
+                 (st.st_atime, st.st_mtime + 1))
+        self.assertEqual(sorted(c.listdir("dirA")), ["fileA", "fileB"])
+        del c
+
     def test_isdir(self):
         c = LocalFilesystemCache(self.remotebase)
         self.assertTrue(c.isdir("dirA"))
@@ -202,12 +1016,83 @@ class TestLocalFilesystemCache(unittest.TestCase):
         del c
 
 
+@unittest.skipIf(AsyncFilesystemCache is None, "requires Python 3.6")
+class TestAsyncFilesystemCache(unittest.TestCase):
+    def setUp(self):
+        self.remotebase = tempfile.mkdtemp()
+        for i in range(20):
+            _touch(os.path.join(self.remotebase, "dirA",
+                                "file{:02d}".format(i)), createdirs=True)
+        self.cache = LocalFilesystemCache(self.remotebase)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        del self.cache
+        shutil.rmtree(self.remotebase)
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_retrieve(self):
+        os.mkdir(os.path.join(self.remotebase, "dirA", "file20"))
+        c = AsyncFilesystemCache(self.cache, concurrency=4)
+        lpath = self._run(c.retrieve(os.path.join("dirA", "file00")))
+        self.assertEqual(lpath, self.cache(os.path.join("dirA", "file00")))
+        lpaths = self._run(c.retrieve(os.path.join("dirA", "file1*")))
+        self.assertEqual(lpaths, [os.path.join(self.cache.temppath, "dirA",
+                                               "file1{}".format(i))
+                                  for i in range(10)])
+        # directories matching a pattern are left out
+        lpaths = self._run(c.retrieve(os.path.join("dirA", "file2*")))
+        self.assertEqual(lpaths, [])
+        c.close()
+
+    def test_predict(self):
+        for i in range(1, 5):
+            _touch(os.path.join(self.remotebase, "dirB",
+                                "day_00{}.nc".format(i)), createdirs=True)
+        cache = LocalFilesystemCache(self.remotebase, predict=2)
+        c = AsyncFilesystemCache(cache)
+        self._run(c.retrieve(os.path.join("dirB", "day_001.nc")))
+        self._run(c.retrieve(os.path.join("dirB", "day_002.nc")))
+        cache._prefetcher.wait()
+        self.assertEqual(sorted(cache._files.keys()),
+                         [os.path.join("dirB", "day_00{}.nc".format(i))
+                          for i in range(1, 5)])
+        c.close()
+        del cache
+
+    def test_retrieve_errors(self):
+        c = AsyncFilesystemCache(self.cache)
+        with self.assertRaises(RetrieveError) as cm:
+            self._run(c.retrieve(["fileB", os.path.join("dirA", "file00")]))
+        self.assertEqual(list(cm.exception.errors.keys()), ["fileB"])
+        c.close()
+
+    def test_retrieve_iter(self):
+        c = AsyncFilesystemCache(self.cache, concurrency=4)
+        paths = [os.path.join("dirA", "file{:02d}".format(i))
+                 for i in range(20)]
+        lpaths = []
+        iterator = c.retrieve_iter(paths)
+        while True:
+            try:
+                lpaths.append(self._run(iterator.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.assertEqual(sorted(lpaths),
+                         [os.path.join(self.cache.temppath, p)
+                          for p in paths])
+        c.close()
+
+
 class TestSFTPFilesystemCache(unittest.TestCase):
-    def _get_cache(self):
-        hostkey = os.path.join(os.path.dirname(__file__), "id_rsa.pub")
+    def _get_cache(self, **kwargs):
         return SFTPFilesystemCache(".", "localhost", getpass.getuser(),
                                    port=17023, password="test",
-                                   ssh_hostkey=hostkey, ssh_unknown_hosts=True)
+                                   ssh_hostkey=self.hostkey,
+                                   ssh_unknown_hosts=True, **kwargs)
 
     def _start_sftp():
         pass
@@ -217,13 +1102,25 @@ class TestSFTPFilesystemCache(unittest.TestCase):
         self.localbase = tempfile.mkdtemp()
         _touch(os.path.join(self.remotebase, "fileA"))
         _touch(os.path.join(self.remotebase, "dirA", "fileA"), createdirs=True)
+        with open(os.path.join(self.remotebase, "dirA", "data.bin"),
+                  "wb") as fd:
+            fd.write(bytes(bytearray(range(256))) * 20)
+        # the server resolves paths below its root, the cwd by default
+        StubSFTPServer.ROOT = self.remotebase
 
     @classmethod
     def setUpClass(cls):
-        thread.start_new_thread(sftpserver.start_server,
-                                ("localhost", 17023,
-                                 os.path.join(os.path.dirname(__file__),
-                                              "id_rsa"), "WARNING"))
+        # id_rsa.pub is no known_hosts file, which newer paramiko
+        # versions do not accept
+        with open(os.path.join(os.path.dirname(__file__),
+                               "id_rsa.pub")) as fd:
+            keytype, key = fd.read().split()[:2]
+        fd, cls.hostkey = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as fd:
+            fd.write("[localhost]:17023 {} {}\n".format(keytype, key))
+        thread.start_new_thread(benchmarks.serve_sftp,
+                                (17023, os.path.join(os.path.dirname(__file__),
+                                                     "id_rsa")))
         time.sleep(2)
 
     def tearDown(self):
@@ -232,13 +1129,12 @@ class TestSFTPFilesystemCache(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        pass
+        os.remove(cls.hostkey)
 
     def test_initialize(self):
         c = self._get_cache()
 
     def test_retrieve_file(self):
-        raise NotImplementedError()
         c = self._get_cache()
         tmppath = c.temppath
         t0 = datetime.datetime.now()
@@ -248,7 +1144,6 @@ class TestSFTPFilesystemCache(unittest.TestCase):
         del c
 
     def test_retrieve_file_list(self):
-        raise NotImplementedError()
         c = self._get_cache()
         tmppath = c.temppath
         c.retrieve(["fileA", os.path.join("dirA", "fileA")])
@@ -257,7 +1152,6 @@ class TestSFTPFilesystemCache(unittest.TestCase):
         del c
 
     def test_retrieve_file_notfound(self):
-        raise NotImplementedError()
         c = self._get_cache()
         tmppath = c.temppath
         with self.assertRaises(IOError) as cm:
@@ -266,7 +1160,6 @@ class TestSFTPFilesystemCache(unittest.TestCase):
         del c
 
     def test_retrieve_file_call(self):
-        raise NotImplementedError()
         c = self._get_cache()
         tmppath = c.temppath
         lpath = c.retrieve("fileA")
@@ -274,7 +1167,6 @@ class TestSFTPFilesystemCache(unittest.TestCase):
         del c
 
     def test_retrieve_file_time(self):
-        raise NotImplementedError()
         c = self._get_cache()
         tmppath = c.temppath
         lpath = c.retrieve("fileA")
@@ -283,7 +1175,6 @@ class TestSFTPFilesystemCache(unittest.TestCase):
         del c
 
     def test_retrieve_dir(self):
-        raise NotImplementedError()
         c = self._get_cache()
         tmppath = c.temppath
         lpath = c.retrieve(os.path.join("dirA", "fileA"))
@@ -292,9 +1183,8 @@ class TestSFTPFilesystemCache(unittest.TestCase):
         del c
 
     def test_glob(self):
-        raise NotImplementedError()
         def _abspath(filenames):
-            return [os.path.join(self.remotebase, p) for p in filenames]
+            return [os.path.join(".", p) for p in filenames]
         c = self._get_cache()
         actual = c.glob("*")
         required = _abspath(["fileA", "dirA"])
@@ -310,18 +1200,147 @@ class TestSFTPFilesystemCache(unittest.TestCase):
 
     def test_isdir(self):
         c = self._get_cache()
-        self.assertFalse(c.isdir("hamster.db"))
-        self.assertTrue(c.isdir("etc"))
+        self.assertFalse(c.isdir(os.path.join("dirA", "data.bin")))
+        self.assertTrue(c.isdir("dirA"))
         self.assertRaises(IOError, c.isdir, "doesntexist")
         del c
 
     def test_isfile(self):
         c = self._get_cache()
-        self.assertTrue(c.isfile("hamster.db"))
-        self.assertFalse(c.isfile("etc"))
+        self.assertTrue(c.isfile(os.path.join("dirA", "data.bin")))
+        self.assertFalse(c.isfile("dirA"))
         self.assertRaises(IOError, c.isfile, "doesntexist")
         del c
 
+    def test_retrieve_chunked(self):
+        c = self._get_cache(chunk_threshold=None)
+        with open(c.retrieve(os.path.join("dirA", "data.bin")), "rb") as fd:
+            required = fd.read()
+        del c
+        c = self._get_cache(chunk_threshold=0, chunk_size=1000)
+        with open(c.retrieve(os.path.join("dirA", "data.bin")), "rb") as fd:
+            actual = fd.read()
+        self.assertEqual(actual, required)
+        del c
+
+    def test_retrieve_delta_fallback(self):
+        # the stub server runs no commands, so that the block hashes
+        # of the source are not available
+        c = self._get_cache(delta_threshold=0)
+        path = os.path.join("dirA", "data.bin")
+        c.retrieve(path)
+        sourcepath = os.path.join(self.remotebase, path)
+        with open(sourcepath, "wb") as fd:
+            fd.write(b"changed" * 1000)
+        st = os.stat(sourcepath)
+        os.utime(sourcepath, (st.st_atime, st.st_mtime + 10))
+        with open(c.retrieve(path), "rb") as fd:
+            self.assertEqual(fd.read(), b"changed" * 1000)
+        del c
+
+    def test_retrieve_resume(self):
+        c = self._get_cache(chunk_threshold=None)
+        path = os.path.join("dirA", "data.bin")
+        data = bytes(bytearray(range(256))) * 20
+        c._prepare_targetpath(path)
+        partpath = c._partpath(c._construct_temppath(path), c._stat(path))
+        with open(partpath, "wb") as fd:
+            fd.write(data[:1000])
+        with open(c.retrieve(path), "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        # only the missing part was transferred
+        self.assertEqual(c.stats()["bytes_fetched"], len(data) - 1000)
+        del c
+
+    def test_benchmarks(self):
+        out = io.StringIO()
+        results = benchmarks.main(
+            ["--backends", "sftp", "--port", "17025", "--workloads",
+             "small_files,huge_files", "--small-files", "5",
+             "--huge-files", "1", "--huge-size", "1"], out)
+        self.assertEqual([r.workload for r in results],
+                         ["small_files/miss", "small_files/hit",
+                          "huge_files/miss"])
+        self.assertEqual([r.backend for r in results], ["sftp"] * 3)
+
+    def test_remote_checksum(self):
+        # without commands on the server, only sidecar files are used
+        with open(os.path.join(self.remotebase, "dirA", "fileA.sha256"),
+                  "w") as fd:
+            fd.write("0" * 64 + "  fileA\n")
+        c = self._get_cache(checksum="sha256", remote_checksum=True)
+        path = os.path.join("dirA", "data.bin")
+        with open(c.retrieve(path), "rb") as fd:
+            data = fd.read()
+        self.assertEqual(data, bytes(bytearray(range(256))) * 20)
+        with self.assertRaises(IOError) as cm:
+            c.retrieve(os.path.join("dirA", "fileA"))
+        self.assertEqual(cm.exception.errno, errno.EIO)
+        del c
+
+    def test_stale_parts(self):
+        c = self._get_cache()
+        stale = [os.path.join(c.temppath, "dirA", "data.bin.1-2.part"),
+                 os.path.join(c.temppath, "dirA", "fileA.3-4.chunked.part"),
+                 os.path.join(c.temppath, "fileA.5-6.0.delta.part")]
+        for partpath in stale:
+            _touch(partpath, createdirs=True)
+        # partial downloads of other versions are never resumed
+        c.retrieve(os.path.join("dirA", "data.bin"))
+        self.assertFalse(os.path.exists(stale[0]))
+        self.assertTrue(os.path.exists(stale[1]))
+        c.clean(os.path.join("dirA", "fileA"))
+        self.assertFalse(os.path.exists(stale[1]))
+        self.assertTrue(os.path.exists(stale[2]))
+        c.clean()
+        self.assertFalse(os.path.exists(stale[2]))
+        del c
+
+    def test_open_lazy(self):
+        c = self._get_cache(chunk_threshold=None)
+        with open(c.retrieve(os.path.join("dirA", "data.bin")), "rb") as fd:
+            required = fd.read()
+        del c
+        c = self._get_cache(range_blocksize=1000, readahead=0)
+        with c.open(os.path.join("dirA", "data.bin")) as fd:
+            fd.seek(1500)
+            self.assertEqual(fd.read(100), required[1500:1600])
+            self.assertNotIn(os.path.join("dirA", "data.bin"), c._files)
+            self.assertEqual(fd.read(), required[1600:])
+            fd.seek(0)
+            self.assertEqual(fd.read(1500), required[:1500])
+        self.assertIn(os.path.join("dirA", "data.bin"), c._files)
+        del c
+
+    def test_sync(self):
+        c = self._get_cache()
+        synced = c.sync("dirA")
+        self.assertTrue(synced)
+        for path in synced:
+            self.assertIn(path, c._files)
+        self.assertEqual(c.sync("dirA"), [])
+        del c
+
+    def test_lazy_connect(self):
+        c = SFTPFilesystemCache(".", "localhost", getpass.getuser(),
+                                port=17024, password="test")
+        self.assertEqual(c._connections._nopen, 0)
+        # no server listens on this port
+        self.assertRaises(socket.error, c.retrieve, "fileA")
+        del c
+
+    def test_connection_reuse(self):
+        c = self._get_cache()
+        c.isdir("dirA")
+        c.isfile(os.path.join("dirA", "data.bin"))
+        c.listdir("")
+        self.assertEqual(c._connections._nopen, 1)
+        transport = c._connections._clients[0].get_transport()
+        transport.close()
+        self.assertTrue(c.isdir("dirA"))
+        self.assertEqual(c._connections._nopen, 1)
+        del c
+
     def test_listdir_empty(self):
         c = self._get_cache()
         actual = c.listdir("")